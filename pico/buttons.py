@@ -0,0 +1,93 @@
+from machine import Pin
+import utime
+from collections import deque
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+SHORT = 'short' # released before LONG_PRESS_MS
+LONG = 'long' # held for LONG_PRESS_MS
+REPEAT = 'repeat' # still held, every REPEAT_MS after the long press
+DEBOUNCE_MS = 30
+LONG_PRESS_MS = 600
+REPEAT_MS = 300
+POLL_MS = 20 # while a key is held
+MAX_EVENTS = 8 # per listener, the oldest event is dropped when a queue is full
+
+# Queue of (key, event) tuples of one listener
+class ButtonEvents:
+    def __init__(self):
+        self.__events = deque((), MAX_EVENTS)
+        self.ready = asyncio.Event() # set while there are events queued
+
+    def put(self, event):
+        self.__events.append(event)
+        self.ready.set()
+
+    async def get(self):
+        while not len(self.__events):
+            self.ready.clear()
+            await self.ready.wait()
+        return self.__events.popleft()
+
+# Keys on pins pulled up, pressed when low. Edges only wake run() through a pin interrupt, so nothing is polled while
+# the keys are idle. run() then waits for the key to settle (debouncing), measures how long it's held with ticks_ms
+# and turns it into SHORT, LONG and REPEAT events, keys being their index in pins.
+# Events go to the listener that started listening last, e.g. a selection on top of the regular key handling.
+# Keys held when a listener starts are ignored until released, so the long press that opened it doesn't leak into it
+class Buttons:
+    def __init__(self, pins):
+        self.keys = [Pin(pin, Pin.IN, Pin.PULL_UP) for pin in pins]
+        self.__edge = asyncio.ThreadSafeFlag()
+        self.__pressed_at = [None] * len(pins) # ticks_ms of the press of held keys
+        self.__next_event = [0] * len(pins) # ticks_ms of the next LONG or REPEAT event of held keys
+        self.__long = [False] * len(pins) # held keys that had their LONG event
+        self.__ignored = [False] * len(pins)
+        self.__listeners = []
+        for key in self.keys:
+            key.irq(lambda pin: self.__edge.set(), Pin.IRQ_FALLING | Pin.IRQ_RISING)
+
+    # start receiving all events, until stop_listening()
+    def listen(self):
+        events = ButtonEvents()
+        self.__listeners.append(events)
+        for i in range(len(self.keys)):
+            if self.__pressed_at[i] is not None:
+                self.__ignored[i] = True
+        return events
+
+    def stop_listening(self, events):
+        self.__listeners.remove(events)
+
+    def __emit(self, key, event):
+        if not self.__ignored[key] and len(self.__listeners):
+            self.__listeners[-1].put((key, event))
+
+    async def run(self):
+        while 1:
+            if any(t is not None for t in self.__pressed_at):
+                await asyncio.sleep_ms(POLL_MS)
+            else:
+                await self.__edge.wait()
+                await asyncio.sleep_ms(DEBOUNCE_MS)
+            levels = [key.value() == 0 for key in self.keys]
+            # releases have to settle too
+            if any(self.__pressed_at[i] is not None and not levels[i] for i in range(len(levels))):
+                await asyncio.sleep_ms(DEBOUNCE_MS)
+                levels = [key.value() == 0 for key in self.keys]
+            now = utime.ticks_ms()
+            for i, pressed in enumerate(levels):
+                if pressed and self.__pressed_at[i] is None:
+                    self.__pressed_at[i] = now
+                    self.__next_event[i] = utime.ticks_add(now, LONG_PRESS_MS)
+                    self.__long[i] = False
+                elif pressed and utime.ticks_diff(now, self.__next_event[i]) >= 0:
+                    self.__emit(i, REPEAT if self.__long[i] else LONG)
+                    self.__long[i] = True
+                    self.__next_event[i] = utime.ticks_add(self.__next_event[i], REPEAT_MS)
+                elif not pressed and self.__pressed_at[i] is not None:
+                    if not self.__long[i]:
+                        self.__emit(i, SHORT)
+                    self.__pressed_at[i] = None
+                    self.__ignored[i] = False
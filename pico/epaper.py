@@ -40,6 +40,24 @@ DC_PIN          = 8
 CS_PIN          = 9
 BUSY_PIN        = 13
 
+# modes the panel can be initialized in
+MODE_4GRAY = 0
+MODE_BW = 1
+
+# Lookup tables from a 4-gray buffer byte (4 pixels of 2 bits, first pixel in the lowest bits) to the 4 bits of
+# those pixels in the two 1-bit planes sent to the display, first pixel in the highest bit.
+# Plane 0x10 gets the low bit of each pixel (white and gray2 are 1), plane 0x13 the high bit (white and gray1 are 1)
+def gray_plane_lut(bit):
+    lut = bytearray(256)
+    for b in range(256):
+        nibble = 0
+        for k in range(4):
+            nibble = (nibble << 1) | ((b >> (2*k + bit)) & 1)
+        lut[b] = nibble
+    return lut
+GRAY_PLANE_LUT_10 = gray_plane_lut(0)
+GRAY_PLANE_LUT_13 = gray_plane_lut(1)
+
 EPD_2in7_lut_vcom_dc = [
     0x00,0x00,
     0x00,0x08,0x00,0x00,0x00,0x02,
@@ -161,6 +179,15 @@ class EPD_2in7:
         self.gray_lut_wb = EPD_2in7_gray_lut_wb
         self.gray_lut_bb = EPD_2in7_gray_lut_bb
         
+        # LUTs as bytes so they can be sent in one transfer
+        self.luts = [(0x20, bytes(self.lut_vcom_dc[:44]))] + [
+            (command, bytes(lut[:42])) for command, lut in
+            ((0x21, self.lut_ww), (0x22, self.lut_bw), (0x23, self.lut_bb), (0x24, self.lut_wb))]
+        self.gray_luts = [(0x20, bytes(self.gray_lut_vcom[:44]))] + [
+            (command, bytes(lut[:42])) for command, lut in
+            ((0x21, self.gray_lut_ww), (0x22, self.gray_lut_bw), (0x23, self.gray_lut_wb),
+             (0x24, self.gray_lut_bb), (0x25, self.gray_lut_ww))]
+        
         self.white = 0xff
         self.lightgray = 0x55
         self.darkgray = 0xaa
@@ -176,6 +203,12 @@ class EPD_2in7:
         self.buffer_4Gray = bytearray(self.height * self.width // 4)
         # self.image1Gray = framebuf.FrameBuffer(self.buffer_1Gray, self.width, self.height, framebuf.MONO_HLSB)
         self.image4Gray = framebuf.FrameBuffer(self.buffer_4Gray, self.width, self.height, framebuf.GS2_HMSB)
+        # 1-bit planes the 4-gray buffer is converted into before sending
+        # plane_10 is also kept up to date by partial refreshes, as the old data of the next partial refresh
+        self.plane_10 = bytearray(self.height * self.width // 8)
+        self.plane_13 = bytearray(self.height * self.width // 8)
+        self.partial_window = bytearray(8)
+        self.mode = None # MODE_4GRAY or MODE_BW, what the panel was last initialized for
         
         self.EPD_2IN7_Init_4Gray()
         self.EPD_2IN7_Clear()
@@ -216,6 +249,13 @@ class EPD_2in7:
         self.digital_write(self.cs_pin, 0)
         self.spi_writebyte([data])
         self.digital_write(self.cs_pin, 1)
+
+    # send a whole buffer of data in a single transfer
+    def send_data_buffer(self, buf):
+        self.digital_write(self.dc_pin, 1)
+        self.digital_write(self.cs_pin, 0)
+        self.spi.write(buf)
+        self.digital_write(self.cs_pin, 1)
         
     def ReadBusy(self):
         print("e-Paper busy")
@@ -225,50 +265,84 @@ class EPD_2in7:
         print("e-Paper busy release")
         
     def SetLut(self):
-        self.send_command(0x20)
-        for count in range(0, 44):
-            self.send_data(self.lut_vcom_dc[count])
-            
-        self.send_command(0x21)
-        for count in range(0, 42):
-            self.send_data(self.lut_ww[count])
-        
-        self.send_command(0x22)
-        for count in range(0, 42):
-            self.send_data(self.lut_bw[count])
-            
-        self.send_command(0x23)
-        for count in range(0, 42):
-            self.send_data(self.lut_bb[count])
-            
-        self.send_command(0x24)
-        for count in range(0, 42):
-            self.send_data(self.lut_wb[count])
+        for command, lut in self.luts:
+            self.send_command(command)
+            self.send_data_buffer(lut)
             
     def gray_SetLut(self):
-        self.send_command(0x20)
-        for count in range(0, 44):
-            self.send_data(self.gray_lut_vcom[count])
-            
-        self.send_command(0x21)
-        for count in range(0, 42):
-            self.send_data(self.gray_lut_ww[count])
+        for command, lut in self.gray_luts:
+            self.send_command(command)
+            self.send_data_buffer(lut)
+
+    # Black and white mode as initialized by Waveshare's EPD_2IN7_Init(), with the black and white LUTs (self.luts).
+    # Partial refreshes run in this mode, Waveshare's 2.7" drivers use these LUTs for their partial refreshes too
+    def EPD_2IN7_Init(self):
         
-        self.send_command(0x22)
-        for count in range(0, 42):
-            self.send_data(self.gray_lut_bw[count])
-            
-        self.send_command(0x23)
-        for count in range(0, 42):
-            self.send_data(self.gray_lut_wb[count])
-            
-        self.send_command(0x24)
-        for count in range(0, 42):
-            self.send_data(self.gray_lut_bb[count])
-            
-        self.send_command(0x25)
-        for count in range(0, 42):
-            self.send_data(self.gray_lut_ww[count])
+        self.reset()
+        
+        self.send_command(0x01)  # POWER SETTING
+        self.send_data (0x03)
+        self.send_data (0x00)
+        self.send_data (0x2b)
+        self.send_data (0x2b)
+        self.send_data (0x09)
+
+        self.send_command(0x06)  # booster soft start
+        self.send_data (0x07)  # A
+        self.send_data (0x07)  # B
+        self.send_data (0x17)  # C 
+
+        self.send_command(0xF8)  # boost??
+        self.send_data (0x60)
+        self.send_data (0xA5)
+
+        self.send_command(0xF8)  # boost??
+        self.send_data (0x89)
+        self.send_data (0xA5)
+
+        self.send_command(0xF8)  # boost??
+        self.send_data (0x90)
+        self.send_data (0x00)
+
+        self.send_command(0xF8)  # boost??
+        self.send_data (0x93)
+        self.send_data (0x2A)
+
+        self.send_command(0xF8)  # boost??
+        self.send_data (0xa0)
+        self.send_data (0xa5)
+
+        self.send_command(0xF8)  # boost??
+        self.send_data (0xa1)
+        self.send_data (0x00)
+
+        self.send_command(0xF8)  # boost??
+        self.send_data (0x73)
+        self.send_data (0x41)
+
+        self.send_command(0x16)
+        self.send_data(0x00)
+
+        self.send_command(0x04)
+        self.ReadBusy()
+
+        self.send_command(0x00)  # panel setting
+        self.send_data(0xaf)  # KW-BF   KWR-AF	BWROTP 0f
+
+        self.send_command(0x30)  # PLL setting
+        self.send_data (0x3a)  # 100hz 
+
+        self.send_command(0x61)  # resolution setting
+        self.send_data (0x00)  # 176
+        self.send_data (0xb0)
+        self.send_data (0x01)  # 264
+        self.send_data (0x08)
+
+        self.send_command(0x82)  # vcom_DC setting
+        self.send_data (0x12)
+
+        self.SetLut()
+        self.mode = MODE_BW
 
     def EPD_2IN7_Init_4Gray(self):
         
@@ -337,99 +411,42 @@ class EPD_2in7:
 
         self.send_command(0X50)  # VCOM AND DATA INTERVAL SETTING			
         self.send_data(0x97)
+        self.mode = MODE_4GRAY
             
     def EPD_2IN7_Clear(self):
-        high = self.height
-        if( self.width % 8 == 0) :
-            wide =  self.width // 8
-        else :
-            wide =  self.width // 8 + 1
-
+        for i in range(len(self.plane_10)):
+            self.plane_10[i] = 0xff
+            self.plane_13[i] = 0xff
         self.send_command(0x10)
-        for j in range(0, high):
-            for i in range(0, wide):
-                self.send_data(0xff)
-                
+        self.send_data_buffer(self.plane_10)
         self.send_command(0x13)
-        for j in range(0, high):
-            for i in range(0, wide):
-                self.send_data(0xff)
-
+        self.send_data_buffer(self.plane_13)
         
         self.send_command(0x12)
         self.ReadBusy()
         
+    # Split the 4-gray buffer into the two 1-bit planes, each output byte holding the pixels of 2 buffer bytes
+    def gray_planes(self, Image):
+        lut_10 = GRAY_PLANE_LUT_10
+        lut_13 = GRAY_PLANE_LUT_13
+        plane_10 = self.plane_10
+        plane_13 = self.plane_13
+        for i in range(len(plane_10)):
+            b0 = Image[2*i]
+            b1 = Image[2*i + 1]
+            plane_10[i] = (lut_10[b0] << 4) | lut_10[b1]
+            plane_13[i] = (lut_13[b0] << 4) | lut_13[b1]
+
     def EPD_2IN7_4Gray_Display(self,Image):
+        if self.mode != MODE_4GRAY:
+            self.EPD_2IN7_Init_4Gray()
+        self.gray_planes(Image)
         
         self.send_command(0x10)
-        for i in range(0, 5808):
-            temp3=0
-            for j in range(0, 2):
-                temp1 = Image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0x03 
-                    if(temp2 == 0x03):
-                        temp3 |= 0x01   # white
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x00   # black
-                    elif(temp2 == 0x02):
-                        temp3 |= 0x00   # gray1
-                    else:   # 0x01
-                        temp3 |= 0x01   # gray2
-                    temp3 <<= 1
-
-                    temp1 >>= 2
-                    temp2 = temp1&0x03 
-                    if(temp2 == 0x03):   # white
-                        temp3 |= 0x01;
-                    elif(temp2 == 0x00):   # black
-                        temp3 |= 0x00;
-                    elif(temp2 == 0x02):
-                        temp3 |= 0x00   # gray1
-                    else:   # 0x01
-                        temp3 |= 0x01   # gray2
-                    
-                    if (( j!=1 ) | ( k!=1 )):
-                        temp3 <<= 1
-
-                    temp1 >>= 2
-                    
-            self.send_data(temp3)
+        self.send_data_buffer(self.plane_10)
         
         self.send_command(0x13)
-        for i in range(0, 5808):
-            temp3=0
-            for j in range(0, 2):
-                temp1 = Image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0x03 
-                    if(temp2 == 0x03):
-                        temp3 |= 0x01   # white
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x00   # black
-                    elif(temp2 == 0x02):
-                        temp3 |= 0x01   # gray1
-                    else:   # 0x01
-                        temp3 |= 0x00   # gray2
-                    temp3 <<= 1
-
-                    temp1 >>= 2
-                    temp2 = temp1&0x03
-                    if(temp2 == 0x03):   # white
-                        temp3 |= 0x01;
-                    elif(temp2 == 0x00):   # black
-                        temp3 |= 0x00;
-                    elif(temp2 == 0x02):
-                        temp3 |= 0x01   # gray1
-                    else:   # 0x01
-                        temp3 |= 0x00   # gray2
-                    
-                    if (( j!=1 ) | ( k!=1 )):
-                        temp3 <<= 1
-
-                    temp1 >>= 2
-
-            self.send_data(temp3)
+        self.send_data_buffer(self.plane_13)
         
         self.gray_SetLut()
         
@@ -439,6 +456,56 @@ class EPD_2in7:
         self.ReadBusy()
 
         
+    # Refresh the window at (x, y) of size w x h from the 4-gray buffer in black and white (the low bit of each pixel,
+    # so white and gray2 are white),
+    # leaving the rest of the display untouched. x and w are widened to multiples of 8.
+    # Much faster than a full 4-gray refresh, but grays inside the window are lost, so it's only meant for windows
+    # that are black and white (see raster.has_gray()). The panel is switched to black and white mode first if
+    # necessary. Repeated partial refreshes leave ghosting, so a full refresh should be done every now and then
+    def display_partial(self, x, y, w, h, Image):
+        x1 = min(self.width, (x + w + 7) & ~7)
+        y1 = min(self.height, y + h)
+        x = max(0, x) & ~7
+        y = max(0, y)
+        if x >= x1 or y >= y1:
+            return
+        w = x1 - x
+        h = y1 - y
+        window = self.partial_window
+        window[0] = x >> 8
+        window[1] = x & 0xf8
+        window[2] = y >> 8
+        window[3] = y & 0xff
+        window[4] = w >> 8
+        window[5] = w & 0xf8
+        window[6] = h >> 8
+        window[7] = h & 0xff
+
+        # The old and new 1-bit data of the window are sent a row at a time straight from plane_10, first the old
+        # data, then the new data after writing it into plane_10, so nothing has to be allocated
+        lut_10 = GRAY_PLANE_LUT_10
+        plane_10 = memoryview(self.plane_10)
+        stride = self.width // 8
+        row_bytes = w // 8
+
+        if self.mode != MODE_BW:
+            self.EPD_2IN7_Init()
+        self.send_command(0x14)
+        self.send_data_buffer(window)
+        for row in range(y, y1):
+            j = row * stride + x // 8
+            self.send_data_buffer(plane_10[j:j + row_bytes])
+        self.send_command(0x15)
+        self.send_data_buffer(window)
+        for row in range(y, y1):
+            j = row * stride + x // 8
+            for i in range(j, j + row_bytes):
+                plane_10[i] = (lut_10[Image[2*i]] << 4) | lut_10[Image[2*i + 1]]
+            self.send_data_buffer(plane_10[j:j + row_bytes])
+        self.send_command(0x16)
+        self.send_data_buffer(window)
+        self.ReadBusy()
+
     def Sleep(self):
         self.send_command(0X50)
         self.send_data(0xf7)
@@ -1,7 +1,11 @@
+import os
+import utime
+from array import array
 try:
     import uasyncio as asyncio
 except ImportError:
     import asyncio
+import track_format
 
 # Custom context manager wrapper for open, allows only one file to be open at a time
 FILE_OPEN_LOCK = asyncio.Lock()
@@ -17,7 +21,7 @@ class OpenFileSafely(object):
         self.file.close()
         FILE_OPEN_LOCK.release()
 
-# Reads track CSV's in small chunks as to not interrupt asyncio for too long
+# Reads track CSV's and binary tracks in small chunks as to not interrupt asyncio for too long
 class TrackReader:
     def __init__(self, filename):
         self.__filename = filename
@@ -28,8 +32,20 @@ class TrackReader:
         self.__counter = 1
         self.__CHUNK_SIZE = 20
         self.__initialized = False
+        # binary tracks are read a chunk of records at a time into a reused buffer
+        self.__binary = track_format.is_binary(filename)
+        self.__records = None
+        self.__num_records = 0
+        self.__record_index = 0
 
     async def read_header(self):
+        if self.__binary:
+            async with OpenFileSafely(f'tracks/{self.__filename}', 'rb') as f:
+                track_format.check_header(f.read(track_format.HEADER_SIZE))
+                self.__curr_seek_pos = f.tell()
+            self.__records = bytearray(track_format.RECORD_SIZE * self.__CHUNK_SIZE)
+            return
+
         # figure out which columns are which
         async with OpenFileSafely(f'tracks/{self.__filename}') as f:
             header = f.readline()
@@ -63,6 +79,9 @@ class TrackReader:
             # class is now initialized
             self.__initialized = True
 
+        if self.__binary:
+            return await self.__next_record()
+
         if self.__file is None:
             await self.__open_file()
 
@@ -88,6 +107,174 @@ class TrackReader:
         self.__counter += 1
         return lat, long
 
+    async def __next_record(self):
+        if self.__record_index == self.__num_records:
+            # read the next chunk of records
+            async with OpenFileSafely(f'tracks/{self.__filename}', 'rb') as f:
+                f.seek(self.__curr_seek_pos)
+                self.__num_records = f.readinto(self.__records) // track_format.RECORD_SIZE
+                self.__curr_seek_pos += self.__num_records * track_format.RECORD_SIZE
+            self.__record_index = 0
+            if self.__num_records == 0:
+                raise StopAsyncIteration
+            # allow asyncio to execute other code in event loop
+            await asyncio.sleep(0)
+
+        _, lat, long, _, _ = track_format.unpack_record(self.__records, self.__record_index * track_format.RECORD_SIZE)
+        self.__record_index += 1
+        return lat / 1e6, long / 1e6
+
+# Per-track locks, so a track can be kept open while it is streamed without blocking every other file
+TRACK_LOCKS = {}
+def track_lock(filename):
+    lock = TRACK_LOCKS.get(filename)
+    if lock is None:
+        lock = TRACK_LOCKS[filename] = asyncio.Lock()
+    return lock
+
+# Streams the points of a track (binary or CSV) in batches.
+# The file stays open for the whole stream while the track's own lock is held, and is read in fixed size
+# blocks into a reused buffer. Each iteration returns (lats, longs, n): two arrays holding n latitudes and
+# longitudes in microdegrees. The arrays are reused, so they are only valid until the next batch is read.
+# Control is given back to the event loop whenever time_budget_ms has been used since it last was.
+# Use it as an async context manager (async with TrackStream(...) as stream), so the file is closed and the lock
+# released even if iteration is stopped early, raises or is cancelled.
+# For binary tracks, ranges can be a sorted list of [start, end) record ranges (see TrackIndex.ranges()) to only
+# read those records. batch_start is the record index of the first point of the current batch, so a gap between
+# ranges can be detected.
+class TrackStream:
+    def __init__(self, filename, batch_size=64, time_budget_ms=20, ranges=None):
+        self.__filename = filename
+        self.__ranges = ranges if track_format.is_binary(filename) else None
+        self.__range_index = 0
+        self.__record = 0 # index of the next record to read
+        self.batch_start = 0
+        self.__file = None
+        self.__lock = track_lock(filename)
+        self.__binary = track_format.is_binary(filename)
+        self.__batch_size = batch_size
+        self.__time_budget = time_budget_ms
+        self.__slice_start = 0
+        self.lats = array('i', [0] * batch_size)
+        self.longs = array('i', [0] * batch_size)
+        if self.__binary:
+            self.__block = bytearray(track_format.RECORD_SIZE * batch_size)
+        else:
+            self.__block = bytearray(512)
+            self.__partial_line = b''
+            self.__lines = []
+            self.__line_index = 0
+            self.__eof = False
+            self.__lat_col = None
+            self.__long_col = None
+        self.__block_mv = memoryview(self.__block)
+
+    async def __open(self):
+        await self.__lock.acquire()
+        try:
+            self.__file = open(f'tracks/{self.__filename}', 'rb')
+        except Exception:
+            self.__lock.release()
+            raise
+        if self.__binary:
+            track_format.check_header(self.__file.read(track_format.HEADER_SIZE))
+        else:
+            # figure out which columns are which
+            cols = self.__file.readline().decode().split(',')
+            for i,col in enumerate(cols):
+                if 'latitude' in col:
+                    self.__lat_col = i
+                elif 'longitude' in col:
+                    self.__long_col = i
+            if self.__lat_col is None or self.__long_col is None:
+                self.close()
+                raise Exception('Unable to parse CSV file:', self.__filename)
+        self.__slice_start = utime.ticks_ms()
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+            self.__lock.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.__file is None:
+            await self.__open()
+        elif utime.ticks_diff(utime.ticks_ms(), self.__slice_start) >= self.__time_budget:
+            # allow asyncio to execute other code in event loop
+            await asyncio.sleep(0)
+            self.__slice_start = utime.ticks_ms()
+
+        n = self.__read_binary() if self.__binary else self.__read_csv()
+        if n == 0:
+            self.close()
+            raise StopAsyncIteration
+        self.batch_start = self.__record
+        self.__record += n
+        return self.lats, self.longs, n
+
+    def __read_binary(self):
+        record_size = track_format.RECORD_SIZE
+        if self.__ranges is None:
+            n = self.__file.readinto(self.__block) // record_size
+        else:
+            n = 0
+            while self.__range_index < len(self.__ranges):
+                start, end = self.__ranges[self.__range_index]
+                if self.__record >= end:
+                    self.__range_index += 1
+                    continue
+                if self.__record < start:
+                    self.__file.seek(track_format.HEADER_SIZE + start * record_size)
+                    self.__record = start
+                count = min(self.__batch_size, end - self.__record)
+                n = self.__file.readinto(self.__block_mv[:count * record_size]) // record_size
+                if n == 0:
+                    # end of file
+                    self.__range_index = len(self.__ranges)
+                break
+        lats = self.lats
+        longs = self.longs
+        for i in range(n):
+            _, lats[i], longs[i], _, _ = track_format.unpack_record(self.__block, i * record_size)
+        return n
+
+    def __read_csv(self):
+        n = 0
+        while n < self.__batch_size:
+            if self.__line_index == len(self.__lines):
+                # split the next block into lines
+                if self.__eof:
+                    break
+                num_bytes = self.__file.readinto(self.__block)
+                if not num_bytes:
+                    # last line may not end in a newline
+                    self.__eof = True
+                    self.__lines = [self.__partial_line]
+                else:
+                    self.__lines = (self.__partial_line + bytes(self.__block_mv[:num_bytes])).split(b'\n')
+                    self.__partial_line = self.__lines.pop()
+                self.__line_index = 0
+                continue
+            line = self.__lines[self.__line_index]
+            self.__line_index += 1
+            if line.strip() == b'':
+                continue
+            parts = line.split(b',')
+            self.lats[n] = int(round(float(parts[self.__lat_col]) * 1e6))
+            self.longs[n] = int(round(float(parts[self.__long_col]) * 1e6))
+            n += 1
+        return n
+
 # Does a file exist? (os.access() not implemented in upython)
 async def file_exists(file):
     try:
@@ -97,4 +284,116 @@ async def file_exists(file):
     except OSError:
         return False
     finally:
-        FILE_OPEN_LOCK.release()
\ No newline at end of file
+        FILE_OPEN_LOCK.release()
+
+TRACK_JOURNAL = 'tracks.journal'
+
+# Buffers binary track records in memory and appends them to the track file in batches, so the file is not
+# opened for every point. A batch is flushed once flush_count entries are buffered, once flush_interval
+# seconds have passed since the last flush, or when the writer is closed.
+# Every flush is first written to TRACK_JOURNAL, then appended to the track, then the journal is removed.
+# If power is lost during a flush, recover_track_journal() completes it on the next boot, so at most the
+# entries buffered since the last flush are lost.
+# If a TrackIndex is given, it is updated with every point but only saved every index_save_interval seconds and on
+# close(), since it holds all tracks. If power is lost in between, TrackIndex.sync() finds the track's size out of
+# date on the next boot and rebuilds its entry.
+class TrackWriter:
+    def __init__(self, filename, buffer_size=1024, flush_count=10, flush_interval=30, index=None,
+                 index_save_interval=600):
+        self.filename = filename
+        self.__index = index
+        self.__index_save_interval = index_save_interval * 1000
+        self.__path = f'tracks/{filename}'
+        self.__buf = bytearray(buffer_size)
+        self.__mv = memoryview(self.__buf)
+        self.__len = 0
+        self.__count = 0
+        self.__flush_count = flush_count
+        self.__flush_interval = flush_interval * 1000
+        self.__last_flush = utime.ticks_ms()
+        self.__last_index_save = self.__last_flush
+        # counters
+        self.points_written = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.last_flush_ms = 0
+        self.max_flush_ms = 0
+
+    # create the track file
+    async def create(self):
+        async with OpenFileSafely(self.__path, 'wb') as log:
+            log.write(track_format.header())
+
+    # pack the point straight into the buffer
+    async def write_point(self, time, lat, long, sats, pdop):
+        if self.__len + track_format.RECORD_SIZE > len(self.__buf):
+            await self.flush()
+        track_format.pack_record(self.__buf, self.__len, time, lat, long, sats, pdop)
+        self.__len += track_format.RECORD_SIZE
+        if self.__index is not None:
+            self.__index.add_point(self.filename, time, lat, long)
+        self.__count += 1
+        self.points_written += 1
+        if self.__count >= self.__flush_count or \
+                utime.ticks_diff(utime.ticks_ms(), self.__last_flush) >= self.__flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        self.__last_flush = utime.ticks_ms()
+        if self.__len == 0:
+            return
+        data = self.__mv[:self.__len]
+        async with OpenFileSafely(TRACK_JOURNAL, 'wb') as journal:
+            journal.write(f'{self.__path},{self.__len}\n'.encode())
+            journal.write(data)
+        async with track_lock(self.filename):
+            with open(self.__path, 'ab') as log:
+                log.write(data)
+                size = log.tell()
+        os.remove(TRACK_JOURNAL)
+        # update counters
+        flush_ms = utime.ticks_diff(utime.ticks_ms(), self.__last_flush)
+        self.last_flush_ms = flush_ms
+        self.max_flush_ms = max(self.max_flush_ms, flush_ms)
+        self.bytes_written += self.__len
+        self.flushes += 1
+        self.__len = 0
+        self.__count = 0
+        if self.__index is not None:
+            self.__index.set_size(self.filename, size)
+            if utime.ticks_diff(utime.ticks_ms(), self.__last_index_save) >= self.__index_save_interval:
+                await self.__save_index()
+
+    async def __save_index(self):
+        self.__last_index_save = utime.ticks_ms()
+        await self.__index.save()
+
+    async def close(self):
+        await self.flush()
+        if self.__index is not None:
+            await self.__save_index()
+
+    def stats(self):
+        return f'{self.points_written} points, {self.bytes_written} bytes in {self.flushes} flushes, ' + \
+               f'last flush {self.last_flush_ms}ms, max flush {self.max_flush_ms}ms'
+
+# Complete a TrackWriter flush that was interrupted by a power loss
+async def recover_track_journal():
+    if not await file_exists(TRACK_JOURNAL):
+        return
+    async with OpenFileSafely(TRACK_JOURNAL, 'rb') as journal:
+        header = journal.readline().decode().strip().rsplit(',', 1)
+        data = journal.read()
+    if len(header) == 2 and header[1].isdigit() and len(data) == int(header[1]) and await file_exists(header[0]):
+        path = header[0]
+        # append the journaled entries unless they already made it into the track
+        async with OpenFileSafely(path, 'rb') as log:
+            log.seek(0, 2)
+            size = log.tell()
+            log.seek(max(0, size - len(data)))
+            tail = log.read()
+        if tail != data:
+            async with OpenFileSafely(path, 'ab') as log:
+                log.write(data)
+            print('Recovered', len(data), 'bytes of', path, 'from journal')
+    os.remove(TRACK_JOURNAL)
@@ -0,0 +1,122 @@
+import struct
+try:
+    import micropython
+    VIPER = True
+except ImportError:
+    VIPER = False
+
+# Marker image format
+# A marker image is the e-Paper's GS2_HMSB framebuffer, IMAGE_SIZE bytes, stored either raw (the file is exactly
+# IMAGE_SIZE bytes) or packbits compressed after an 8 byte header:
+#   header: magic 'TMCI', format version (u8), 3 reserved bytes
+#   packbits: a control byte h followed by h + 1 literal bytes if h < 128, or by one byte repeated 257 - h times if
+#             h > 128 (128 is skipped)
+# Photos of signs are mostly uniform areas, which packbits shrinks several times over.
+# This module only uses struct, so it also runs on a host for utils/quantize_img.py
+
+MAGIC = b'TMCI'
+VERSION = 1
+HEADER_FORMAT = '<4sB3x'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+IMAGE_SIZE = 176 * 264 // 4
+
+def header():
+    return struct.pack(HEADER_FORMAT, MAGIC, VERSION)
+
+def check_header(buf):
+    magic, version = struct.unpack_from(HEADER_FORMAT, buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a marker image file')
+
+# compress raw image bytes into a file's contents, header included
+def pack(data):
+    out = bytearray(header())
+    literal = bytearray()
+    def flush():
+        if len(literal):
+            out.append(len(literal) - 1)
+            out.extend(literal)
+            literal[:] = b''
+    i = 0
+    n = len(data)
+    while i < n:
+        run = 1
+        while i + run < n and run < 128 and data[i + run] == data[i]:
+            run += 1
+        # runs of 2 are cheaper as part of a literal
+        if run >= 3:
+            flush()
+            out.append(257 - run)
+            out.append(data[i])
+            i += run
+        else:
+            literal.append(data[i])
+            i += 1
+            if len(literal) == 128:
+                flush()
+    flush()
+    return bytes(out)
+
+if VIPER:
+    @micropython.viper
+    def _unpack(src: ptr8, n: int, dst: ptr8, size: int) -> int:
+        i = 0
+        o = 0
+        while i < n and o < size:
+            h = src[i]
+            i += 1
+            if h < 128:
+                count = h + 1
+                if count > n - i:
+                    count = n - i
+                if count > size - o:
+                    count = size - o
+                for k in range(count):
+                    dst[o + k] = src[i + k]
+                i += h + 1
+                o += count
+            elif h > 128 and i < n:
+                count = 257 - h
+                if count > size - o:
+                    count = size - o
+                value = src[i]
+                for k in range(count):
+                    dst[o + k] = value
+                i += 1
+                o += count
+        return o
+
+def _unpack_int(src, n, dst, size):
+    src = memoryview(src)
+    dst = memoryview(dst)
+    i = 0
+    o = 0
+    while i < n and o < size:
+        h = src[i]
+        i += 1
+        if h < 128:
+            count = min(h + 1, n - i, size - o)
+            dst[o:o+count] = src[i:i+count]
+            i += h + 1
+            o += count
+        elif h > 128 and i < n:
+            count = min(257 - h, size - o)
+            dst[o:o+count] = bytes((src[i],)) * count
+            i += 1
+            o += count
+    return o
+
+# decompress the packbits data after the header into buf, returns the number of bytes written
+def unpack(data, buf):
+    if VIPER:
+        return _unpack(data, len(data), buf, len(buf))
+    return _unpack_int(data, len(data), buf, len(buf))
+
+# Read a marker image file of file_size bytes from f into buf, an IMAGE_SIZE framebuffer
+def read_into(f, file_size, buf):
+    if file_size == len(buf):
+        f.readinto(buf)
+        return
+    check_header(f.read(HEADER_SIZE))
+    if unpack(f.read(), buf) != len(buf):
+        raise ValueError('Truncated marker image')
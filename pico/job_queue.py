@@ -0,0 +1,70 @@
+from collections import deque
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+MAX_JOBS = 16 # per priority, the oldest job is dropped when a queue is full
+
+class Job:
+    def __init__(self, func, args, is_async, priority, key, dropped_flag):
+        self.func = func
+        self.args = args
+        self.is_async = is_async
+        self.priority = priority
+        self.key = key
+        self.dropped_flag = dropped_flag # set if the job is dropped instead of run
+        self.dropped = False
+
+# Bounded job queues, one per priority, for the e-Paper jobs.
+# Jobs with a key coalesce: queueing a job drops the queued job with the same key, so only the latest
+# e.g. map drawing is run. Queued jobs can also be cancelled by key. Dropped jobs are only marked as dropped and
+# skipped when they come up, since deques can't remove items from the middle.
+class JobQueue:
+    def __init__(self, max_jobs=MAX_JOBS):
+        self.__max_jobs = max_jobs
+        self.__queues = [deque((), max_jobs), deque((), max_jobs)]
+        self.__latest = {} # key -> queued job with that key
+        self.ready = asyncio.Event() # set while there may be jobs queued
+
+    def put(self, job):
+        if job.key is not None:
+            old = self.__latest.get(job.key)
+            if old is not None:
+                self.__drop(old)
+            self.__latest[job.key] = job
+        queue = self.__queues[job.priority]
+        if len(queue) == self.__max_jobs:
+            self.__drop(queue.popleft())
+        queue.append(job)
+        self.ready.set()
+
+    def __drop(self, job):
+        if job.key is not None and self.__latest.get(job.key) is job:
+            self.__latest.pop(job.key)
+        if not job.dropped:
+            job.dropped = True
+            print('Dropped e-paper job', job.key)
+            if job.dropped_flag is not None:
+                job.dropped_flag.set()
+
+    def cancel(self, *keys):
+        for key in keys:
+            job = self.__latest.get(key)
+            if job is not None:
+                self.__drop(job)
+
+    # next job to run, highest priority first, None if there is none
+    def get(self):
+        for queue in self.__queues:
+            while len(queue):
+                job = queue.popleft()
+                if job.dropped:
+                    continue
+                if job.key is not None:
+                    self.__latest.pop(job.key)
+                return job
+        self.ready.clear()
+        return None
@@ -0,0 +1,97 @@
+import os
+import json
+from file_utils import OpenFileSafely, file_exists
+
+# Append-only persistence for a JSON list (junctions, markers) or dict (tracks.json).
+# Every edit appends one operation line to a log file instead of rewriting the whole snapshot:
+#   ["add", item, seq]         append item to a list
+#   ["set", key, value, seq]   set a key of a dict
+#   ["del", item_or_key, seq]  remove an item from a list or a key from a dict
+# seq numbers the operations. On load the snapshot is read and the log is replayed on top of it. Once the log holds
+# compact_after operations, it is folded into a new snapshot, which is written to a temporary file and renamed over
+# the old one. Snapshots with a key also hold the seq of the last operation folded into them ({key: data, 'seq': 12}),
+# so a log that was already folded in before power was lost isn't replayed again. Without a key only 'set' and 'del'
+# are used, which give the same dict when replayed twice. A half-written last line is ignored.
+class Journal:
+    def __init__(self, snapshot, key=None, compact_after=50):
+        self.snapshot = snapshot
+        self.log = snapshot.rsplit('.', 1)[0] + '.log'
+        self.key = key # snapshot is {key: data} instead of just data, e.g. {'junctions': [...]}
+        self.compact_after = compact_after
+        self.data = None
+        self.num_ops = 0 # operations in the log
+        self.seq = 0 # seq of the last operation
+        self.version = 0 # incremented on every change to data
+
+    # load the snapshot and replay the log, default is the data to start with if there is no snapshot
+    async def load(self, default):
+        self.data = default
+        self.seq = 0
+        if await file_exists(self.snapshot):
+            async with OpenFileSafely(self.snapshot, 'r') as f:
+                self.data = json.load(f)
+            if self.key is not None:
+                self.seq = self.data.get('seq', 0)
+                self.data = self.data[self.key]
+        self.num_ops = 0
+        incomplete = False
+        if await file_exists(self.log):
+            async with OpenFileSafely(self.log, 'r') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        print('Ignoring incomplete operation in', self.log)
+                        incomplete = True
+                        break
+                    self.num_ops += 1
+                    # already in the snapshot
+                    if op[-1] <= self.seq:
+                        continue
+                    self.__apply(op)
+                    self.seq = op[-1]
+        # don't append after a half-written line
+        if incomplete:
+            await self.compact()
+        return self.data
+
+    def __apply(self, op):
+        if op[0] == 'add':
+            self.data.append(op[1])
+        elif op[0] == 'set':
+            self.data[op[1]] = op[2]
+        elif op[0] == 'del':
+            if isinstance(self.data, dict):
+                self.data.pop(op[1], None)
+            elif op[1] in self.data:
+                self.data.remove(op[1])
+
+    async def __append(self, op):
+        self.seq += 1
+        op.append(self.seq)
+        self.__apply(op)
+        self.version += 1
+        async with OpenFileSafely(self.log, 'a') as f:
+            f.write(json.dumps(op) + '\n')
+        self.num_ops += 1
+        if self.num_ops >= self.compact_after:
+            await self.compact()
+
+    async def add(self, item):
+        await self.__append(['add', item])
+
+    async def set(self, key, value):
+        await self.__append(['set', key, value])
+
+    async def delete(self, item_or_key):
+        await self.__append(['del', item_or_key])
+
+    # write the current data as the new snapshot and start an empty log
+    async def compact(self):
+        tmp = self.snapshot + '.tmp'
+        async with OpenFileSafely(tmp, 'w') as f:
+            json.dump(self.data if self.key is None else {self.key: self.data, 'seq': self.seq}, f)
+        os.rename(tmp, self.snapshot)
+        if await file_exists(self.log):
+            os.remove(self.log)
+        self.num_ops = 0
@@ -5,12 +5,16 @@ except ImportError:
     import asyncio
 from machine import UART, Pin, soft_reset
 import utime
-import json
 from onboard_led import led, flash_led
 from my_gps_utils import GPS
 from my_epaper_utils import EPD
 import pico_socket_server as pss
-from file_utils import OpenFileSafely, TrackReader, file_exists
+import track_format
+from track_index import TrackIndex
+from spatial_hash import SpatialHash
+from journal import Journal
+from map_tiles import MapTiles, TILES_DIR
+from file_utils import OpenFileSafely, TrackWriter, file_exists, recover_track_journal
 
 # GPS
 gps = GPS(UART(0, tx=Pin(0), rx=Pin(1), baudrate=9600), debug=False)
@@ -18,6 +22,20 @@ gps = GPS(UART(0, tx=Pin(0), rx=Pin(1), baudrate=9600), debug=False)
 # e-Paper
 epd = EPD()
 
+# per-track metadata (bounding box, number of points, ...)
+track_index = TrackIndex()
+
+# tracks.json, junctions and markers are saved as a snapshot plus a log of edits
+tracks_journal = Journal('tracks.json')
+junctions_journal = Journal('junctions.json', key='junctions')
+markers_journal = Journal('markers.json', key='markers')
+JOURNALS = {journal.snapshot: journal for journal in (tracks_journal, junctions_journal, markers_journal)}
+
+# changes whenever anything drawn on the map besides the current position changes
+def data_version():
+    return (track_index.changes, tracks_journal.version, junctions_journal.version, markers_journal.version,
+            map_properties['tiles'].version())
+
 # Program states
 IDLE = 'IDLE'
 TRACKING = 'TRACKING'
@@ -29,6 +47,11 @@ def change_state(newState):
     global CURR_STATE
     CURR_STATE = newState
     print('State change:', newState)
+    # drop queued screens that don't belong to the new state
+    if newState == IDLE:
+        epd.cancel_jobs('tracking_info')
+    else:
+        epd.cancel_jobs('map')
 
 # map properties
 map_properties = {
@@ -37,142 +60,118 @@ map_properties = {
         'levels': ['fit', 200, 400, 800],
         'current': 0 # current zoom level (zero indexed, default is 'fit')
     },
+    'tiles': MapTiles(), # pre-rendered map tiles from utils/build_tiles.py
 }
 
 
 ### Main functionality ###
 
-async def save_tracks_json():
-    async with OpenFileSafely('tracks.json', 'w') as f:
-        json.dump(map_properties['tracks'], f)
-
-async def save_junctions_json():
-    async with OpenFileSafely('junctions.json', 'w') as f:
-        json.dump({'junctions': map_properties['junctions']}, f)
-
-async def save_markers_json():
-    async with OpenFileSafely('markers.json', 'w') as f:
-        json.dump({'markers': map_properties['markers']}, f)
-
 async def add_junction():
     print('Adding junction')
-    await gps.update(3, led)
-    lat, long = gps.latlong()
-    map_properties['junctions'].append({'lat': lat, 'long': long})
-    await save_junctions_json()
+    fix = await gps.get_fix(led=led)
+    lat, long = fix.lat, fix.long
+    junction = {'lat': lat, 'long': long}
+    await junctions_journal.add(junction)
+    map_properties['junction_index'].add(junction)
     print('Number of junctions:', len(map_properties['junctions']))
 
 async def delete_junction():
     print('Deleting junction')
-    await gps.update(3, led)
-    currLatLong = gps.latlong()
-    search_range = 50 # meters
-    index = -1
-    for i, junction in enumerate(map_properties['junctions']):
-        junctionLatLong = (junction['lat'], junction['long'])
-        dist = gps.dist(currLatLong, junctionLatLong)
-        if dist < search_range:
-            search_range = dist
-            index = i
-    if index != -1:
-        map_properties['junctions'].pop(index)
-        await save_junctions_json()
+    fix = await gps.get_fix(led=led)
+    junction, _ = map_properties['junction_index'].nearest(fix.latlong(), 50) # search range in meters
+    if junction is not None:
+        map_properties['junction_index'].remove(junction)
+        await junctions_journal.delete(junction)
     print('Number of junctions:', len(map_properties['junctions']))
 
 async def add_marker(text):
     print('Adding marker')
-    await gps.update(3, led)
-    lat, long = gps.latlong()
+    fix = await gps.get_fix(led=led)
+    lat, long = fix.lat, fix.long
     id = str(gps.time()) # ID to link markers to their corresponding images
     new_marker = {'lat': lat, 'long': long, 'text': text.strip(), 'id': id}
-    map_properties['markers'].append(new_marker)
-    await save_markers_json()
+    await markers_journal.add(new_marker)
+    map_properties['marker_index'].add(new_marker)
     print('Number of markers:', len(map_properties['markers']))
     return new_marker
 
 async def delete_marker():
     print('Deleting nearest marker')
-    await gps.update(3, led)
-    currLatLong = gps.latlong()
-    search_range = 50 # meters
-    index = -1
-    for i, marker in enumerate(map_properties['markers']):
-        markerLatLong = (marker['lat'], marker['long'])
-        dist = gps.dist(currLatLong, markerLatLong)
-        if dist < search_range:
-            search_range = dist
-            index = i
-    if index != -1:
-        print('Deleting', map_properties['markers'][index])
-        deleted_marker = map_properties['markers'].pop(index)
+    fix = await gps.get_fix(led=led)
+    deleted_marker, _ = map_properties['marker_index'].nearest(fix.latlong(), 50) # search range in meters
+    if deleted_marker is not None:
+        print('Deleting', deleted_marker)
+        map_properties['marker_index'].remove(deleted_marker)
+        await markers_journal.delete(deleted_marker)
         marker_id = deleted_marker['id']
         print(marker_id)
         if await file_exists('marker_imgs/'+marker_id):
             os.remove('marker_imgs/'+marker_id)
         print('Number of markers:', len(map_properties['markers']))
-        await save_markers_json()
     else:
         print('No marker found nearby')
 
 async def view_markers():
     print('Viewing nearby markers')
     change_state(STOPPING)
-    await gps.update(3, led)
-    currLatLong = gps.latlong()
-    markers = map_properties['markers']
-    markers.sort(key=lambda marker: gps.dist(currLatLong, (marker['lat'], marker['long'])))
+    fix = await gps.get_fix(led=led)
+    # only the nearest markers fit on the display, find them without sorting the marker list
+    markers = [marker for marker, _ in map_properties['marker_index'].k_nearest(fix.latlong(), 8)]
     finished_flag = asyncio.ThreadSafeFlag()
-    epd.run_in_thread(epd.view_markers, args=(gps, markers, finished_flag), is_async=True)
+    epd.queue_job(epd.view_markers, args=(gps, markers, finished_flag), key='markers', dropped_flag=finished_flag)
     await finished_flag.wait()
+    # pressing key 1 within time_to_wait seconds selects a marker to view its image
     time_to_wait = 20
-    for _ in range(time_to_wait*10):
-        if epd.key1.value() == 0:
-            led.on()
-            utime.sleep(0.3)
-            led.off()
-            utime.sleep(0.7)
-            def callback(curr_val):
-                print(f'Selected marker = {curr_val}:', markers[curr_val-1]['text'])
-            selected_marker = epd.button_select(1, max_val=min(len(markers), 8), on_change_callback=callback)
-            epd.run_in_thread(epd.view_marker_img, (markers[selected_marker-1],), is_async=True)
-            utime.sleep(0.5)
-            break
-        utime.sleep(0.1)
+    deadline = utime.ticks_add(utime.ticks_ms(), time_to_wait * 1000)
+    events = epd.buttons.listen()
+    try:
+        key = None
+        while key != 1:
+            key, _ = await asyncio.wait_for_ms(events.get(), max(0, utime.ticks_diff(deadline, utime.ticks_ms())))
+    except asyncio.TimeoutError:
+        key = None
+    finally:
+        epd.buttons.stop_listening(events)
+    if key == 1 and len(markers):
+        def callback(curr_val):
+            print(f'Selected marker = {curr_val}:', markers[curr_val-1]['text'])
+        selected_marker = await epd.button_select(1, max_val=min(len(markers), 8), on_change_callback=callback)
+        epd.queue_job(epd.view_marker_img, (markers[selected_marker-1],), key='marker_img')
     change_state(IDLE)
     asyncio.create_task(display_trails())
 
+# longitudes are converted to meters at the middle of the map data, see GPS.setReferenceLatitude()
+def update_reference_latitude():
+    bounds = track_index.bounds()
+    return bounds is not None and gps.setReferenceLatitude((bounds[0] + bounds[1]) / 2e6)
+
+# spatial indexes for nearest junction/marker lookups, kept in sync with the lists
+def build_spatial_indexes():
+    map_properties['junction_index'] = SpatialHash(gps.distBetweenLatitudes, gps.distBetweenLongitudes,
+                                                   items=map_properties['junctions'])
+    map_properties['marker_index'] = SpatialHash(gps.distBetweenLatitudes, gps.distBetweenLongitudes,
+                                                 items=map_properties['markers'])
+
 async def update_map_properties():
     print('Updating map properties')
-    map_properties['bounds'] = None
-    tracks = os.listdir('tracks')
-    for track in tracks:
-        async for lat, long in TrackReader(track):
-            # set initial map boundaries
-            if map_properties['bounds'] is None:
-                map_properties['bounds'] = {}
-                map_properties['bounds']['top'] = lat
-                map_properties['bounds']['bottom'] = lat
-                map_properties['bounds']['left'] = long
-                map_properties['bounds']['right'] = long
-            
-            # NOTE latitude is horizontal, longitude is vertical
-            # NOTE latitude increases Northward, longitude increases Eastward
-            # update map properties
-            if lat > map_properties['bounds']['top']:
-                map_properties['bounds']['top'] = lat
-            if lat < map_properties['bounds']['bottom']:
-                map_properties['bounds']['bottom'] = lat
-            if long < map_properties['bounds']['left']:
-                map_properties['bounds']['left'] = long
-            if long > map_properties['bounds']['right']:
-                map_properties['bounds']['right'] = long
-        await asyncio.sleep(0)
+    if update_reference_latitude():
+        build_spatial_indexes()
+    # merge the bounding boxes of all tracks, kept up to date by the index
+    # NOTE latitude is horizontal, longitude is vertical
+    # NOTE latitude increases Northward, longitude increases Eastward
+    bounds = track_index.bounds()
+    if bounds is None:
+        map_properties['bounds'] = None
+        return
+    top, bottom, left, right = bounds # microdegrees
 
     # set additional map properties
-    map_properties['bounds']['top'] = gps.latToMeters(map_properties['bounds']['top'])
-    map_properties['bounds']['bottom'] = gps.latToMeters(map_properties['bounds']['bottom'])
-    map_properties['bounds']['left'] = gps.longToMeters(map_properties['bounds']['left'])
-    map_properties['bounds']['right'] = gps.longToMeters(map_properties['bounds']['right'])
+    map_properties['bounds'] = {
+        'top': gps.latToMeters(top / 1e6),
+        'bottom': gps.latToMeters(bottom / 1e6),
+        'left': gps.longToMeters(left / 1e6),
+        'right': gps.longToMeters(right / 1e6),
+    }
     map_properties['height'] = (map_properties['bounds']['top']-map_properties['bounds']['bottom'])
     map_properties['width'] = (map_properties['bounds']['right']-map_properties['bounds']['left'])
 
@@ -187,7 +186,7 @@ async def change_trail_width():
     global CURR_TRAIL_WIDTH
     def callback(curr_val):
         print('Trail width:', curr_val)
-    CURR_TRAIL_WIDTH = epd.button_select(CURR_TRAIL_WIDTH, on_change_callback=callback)
+    CURR_TRAIL_WIDTH = await epd.button_select(CURR_TRAIL_WIDTH, on_change_callback=callback)
 
     # resume recording if necessary
     if recording_interrupted:
@@ -205,19 +204,18 @@ async def start_recording_trail(log_description=''):
     led.on()
     print('Recording new trail')
     change_state(TRACKING)
-    await gps.update(3)
+    await gps.get_fix()
     led.off()
 
     # create log
     log_description = log_description.strip().replace('+', '-') + '_'
-    log_filename = f'TMC_{log_description}{gps.time()}.csv'
+    log_filename = f'TMC_{log_description}{gps.time()}{track_format.EXTENSION}'
     print('Opening new track log:', log_filename)
-    async with OpenFileSafely('tracks/'+log_filename, 'w') as log:
-        log.write('time,latitude,longitude,satellites visible,pdop\n')
+    writer = TrackWriter(log_filename, index=track_index)
+    await writer.create()
     
     # edit tracks.json
-    map_properties['tracks'][log_filename] = {'width': CURR_TRAIL_WIDTH}
-    await save_tracks_json()
+    await tracks_journal.set(log_filename, {'width': CURR_TRAIL_WIDTH})
     
     # start tracking
     startTime = gps.time()
@@ -227,15 +225,10 @@ async def start_recording_trail(log_description=''):
     numPointsTotal = 0
     newPoints = 0
     while 1:
-        # update and log
-        await gps.update(2, led)
-        lat, long = gps.latlong()
-        satellitesVisible = len(gps.reader.satellites_visible())
-        pdop = gps.reader.pdop
-        logEntry = f'{gps.time()},{lat},{long},{satellitesVisible},{pdop}\n'
-        print(logEntry)
-        async with OpenFileSafely('tracks/'+log_filename, 'a') as log:
-            log.write(logEntry)
+        # wait for new fixes and log
+        fix = await gps.update(2, led)
+        print(f'{fix.time},{fix.lat},{fix.long},{fix.sats},{fix.pdop}')
+        await writer.write_point(fix.time, fix.lat, fix.long, fix.sats, fix.pdop)
         lastPointTime = gps.time()
         numPointsTotal += 1
         newPoints += 1
@@ -244,13 +237,15 @@ async def start_recording_trail(log_description=''):
         if gps.time() - epaperDrawTime > epaperDrawInterval:
             epaperDrawTime = gps.time()
             recordingDuration = gps.time()-startTime
-            epd.run_in_thread(epd.display_tracking_info,
-                              args=(gps.timeFormatted(), recordingDuration, gps.time()-lastPointTime, newPoints, numPointsTotal, CURR_TRAIL_WIDTH),
-                              is_async=True)
+            epd.queue_job(epd.display_tracking_info,
+                          args=(gps.timeFormatted(), recordingDuration, gps.time()-lastPointTime, newPoints, numPointsTotal, CURR_TRAIL_WIDTH),
+                          key='tracking_info')
             newPoints = 0
 
         # delay
         if CURR_STATE == STOPPING:
+            await writer.close()
+            print('Track log:', writer.stats())
             change_state(IDLE)
             break
         await asyncio.sleep(1)
@@ -280,13 +275,17 @@ async def display_trails():
     finished_flag = asyncio.ThreadSafeFlag()
     while CURR_STATE == IDLE:
         await update_map_properties()
+        if map_properties['bounds'] is None:
+            print("No track points recorded yet, can't display trails")
+            return
         
         # draw trails
-        await gps.update(3)
+        await gps.get_fix()
         print('Displaying recorded trails on e-Paper')
         if CURR_STATE != IDLE:
             return
-        epd.run_in_thread(epd.draw_trails, args=(gps, map_properties, finished_flag), is_async=True)
+        epd.queue_job(epd.draw_trails, args=(gps, map_properties, track_index, data_version(), finished_flag),
+                      key='map', dropped_flag=finished_flag)
 
         # wait until finished or state change
         while 1:
@@ -329,15 +328,32 @@ app.add_route('/marker', 'POST', app_route_add_marker)
 
 async def app_route_add_image_marker(request: pss.Request):
     # route should only used if pico is started in image receiving mode due to high memory usage
-    text = request.headers['Marker-Text']
+    text = request.headers.get('marker-text')
+    if text is None:
+        return pss.generate_response(status_code=400, status_text='Bad Request', body='Missing Marker-Text header')
     new_marker = await add_marker(text)
     print('marker text:', text, '\nmarker id:', new_marker['id'])
     async with OpenFileSafely('marker_imgs/'+new_marker['id'], 'wb') as f:
         f.write(request.file)
-    epd.run_in_thread(epd.view_marker_img, args=(new_marker['id'],), is_async=True)
+    epd.queue_job(epd.view_marker_img, args=(new_marker,), key='marker_img')
     return pss.generate_response(html=new_marker['id'])
 app.add_route('/image_marker', 'POST', app_route_add_image_marker)
 
+async def app_route_tile_upload(request: pss.Request):
+    # tiles are uploaded one file at a time by utils/build_tiles.py, index.json last
+    name = request.headers.get('tile-name')
+    if name is None:
+        return pss.generate_response(status_code=400, status_text='Bad Request', body='Missing Tile-Name header')
+    if '/' in name:
+        return pss.generate_response(status_code=400, status_text='Bad Request', body='Invalid tile name')
+    async with OpenFileSafely(f'{TILES_DIR}/{name}', 'wb') as f:
+        f.write(request.file)
+    if name == 'index.json':
+        await map_properties['tiles'].load()
+        map_properties['tiles'].prune()
+    return pss.generate_response(html=name)
+app.add_route('/tile_upload', 'POST', app_route_tile_upload)
+
 async def app_route_view_tracks(request: pss.Request):
     filenames = [file for file in os.listdir('tracks')] + ['tracks.json', 'junctions.json', 'markers.json']
     return pss.generate_response(html=','.join(filenames))
@@ -349,7 +365,10 @@ async def app_route_download(request: pss.Request):
     fileData = None
     if 'TMC_' in filename: # is a track
         filename = f'tracks/{filename}'
-    async with OpenFileSafely(filename, 'r') as f:
+    elif filename in JOURNALS: # fold pending edits into the snapshot before sending it
+        await JOURNALS[filename].compact()
+    mode = 'rb' if track_format.is_binary(filename) else 'r'
+    async with OpenFileSafely(filename, mode) as f:
         fileData = f.read()
     headers = {
         'Content-Disposition': f'attachment; filename="{filename}"',
@@ -358,16 +377,15 @@ async def app_route_download(request: pss.Request):
 app.add_route('/download', 'GET', app_route_download)
 
 async def app_route_loc(request: pss.Request):
-    await gps.update(2, led)
-    lat, long = gps.latlong()
-    latlong = f'{lat},{long}'
+    fix = await gps.get_fix(led=led)
+    latlong = f'{fix.lat},{fix.long}'
     link = f'https://www.google.com/maps/search/{latlong}'
     atag = f'<a href="{link}" target="_blank">{latlong}</a>'
     return pss.generate_response(body=atag)
 app.add_route('/loc', 'GET', app_route_loc)
 
 async def app_route_debug(request: pss.Request):
-    await gps.update(3, led)
+    await gps.get_fix(led=led)
     debugInfo = gps.getDebugInfo().replace('\n', '<br>')
     body = f'''
         <h2>Debugging info</h2>
@@ -391,21 +409,27 @@ async def start_web_server():
 async def main():
     await flash_led()
 
-    # load in tracks, junctions, and markers data
-    async with OpenFileSafely('tracks.json', 'r') as f:
-        tracks_json = json.load(f)
-        tracks = os.listdir('tracks')
-        for track in tracks_json.keys():
-            if track not in tracks:
-                tracks_json.pop(track)
-        map_properties['tracks'] = tracks_json
-    await save_tracks_json()
+    # finish writing track points if power was lost during a flush
+    await recover_track_journal()
+
+    # load in tracks, junctions, and markers data (snapshot plus logged edits)
+    map_properties['tracks'] = await tracks_journal.load({})
+    tracks = os.listdir('tracks')
+    for track in list(map_properties['tracks'].keys()):
+        if track not in tracks:
+            await tracks_journal.delete(track)
+    await track_index.load()
+    await track_index.sync(tracks)
+
+    map_properties['junctions'] = await junctions_journal.load([])
+    map_properties['markers'] = await markers_journal.load([])
 
-    async with OpenFileSafely('junctions.json', 'r') as f:
-        map_properties['junctions'] = json.load(f)['junctions']
+    if TILES_DIR not in os.listdir():
+        os.mkdir(TILES_DIR)
+    await map_properties['tiles'].load()
 
-    async with OpenFileSafely('markers.json', 'r') as f:
-        map_properties['markers'] = json.load(f)['markers']
+    update_reference_latitude()
+    build_spatial_indexes()
 
     # If key1 pressed on startup, initialize gps only and start server immediately.
     # Puts app in marker image receiving mode.
@@ -416,9 +440,9 @@ async def main():
         await gps.initialize()
         await start_web_server()
 
-    # create epaper thread manager and initialize epd
-    asyncio.create_task(epd.manage_threads())
-    epd.run_in_thread(epd.initialize, args=(
+    # start running epaper jobs and initialize epd
+    asyncio.create_task(epd.run_jobs())
+    epd.queue_job(epd.initialize, args=(
         toggle_trail_recording, # key0_shortpress_func
         change_trail_width, # key0_longpress_func
         add_junction, # key1_shortpress_func
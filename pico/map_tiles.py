@@ -0,0 +1,75 @@
+import os
+import json
+import framebuf
+from file_utils import OpenFileSafely, file_exists
+
+TILES_DIR = 'tiles'
+TILE_INDEX_FILE = 'tiles/index.json'
+
+# Map tiles pre-rendered by utils/build_tiles.py from downloaded tracks.
+# Tiles are raw GS2_HMSB framebuffers named '{zoom}_{ty}_{tx}', tile (tx, ty) covering global pixels
+# [tx * tile_size, (tx+1) * tile_size) where x = longitude in meters * scale, y = -latitude in meters * scale and
+# scale = display width / zoom. The index lists the tiles of every zoom level and the tracks drawn into them, with
+# the number of records and the width they were drawn with.
+class MapTiles:
+    def __init__(self):
+        self.index = None
+        self.tracks = {} # track -> (record count, width) of the tracks already drawn into the tiles
+        self.__tiles = {} # zoom -> set of tile names
+        self.__buf = None
+        self.__fb = None
+
+    async def load(self):
+        self.index = None
+        self.tracks = {}
+        self.__tiles = {}
+        if not await file_exists(TILE_INDEX_FILE):
+            return
+        async with OpenFileSafely(TILE_INDEX_FILE, 'r') as f:
+            self.index = json.load(f)
+        self.tracks = {track: (entry['count'], entry['width']) for track, entry in self.index['tracks'].items()}
+        self.__tiles = {zoom: set(names) for zoom, names in self.index['zooms'].items()}
+        print('Map tiles loaded for zoom levels', list(self.__tiles.keys()))
+
+    # delete tiles left over from previous builds
+    def prune(self):
+        for file in os.listdir(TILES_DIR):
+            if file == 'index.json':
+                continue
+            zoom, name = file.split('_', 1)
+            if name not in self.__tiles.get(zoom, ()):
+                os.remove(f'{TILES_DIR}/{file}')
+
+    # Number of the track's first records that are drawn into the tiles, the rest has to be drawn live.
+    # 0 if the tiles don't have the track, have it with another width or with more records than it has now
+    def tiled_records(self, track, count, width):
+        tiled = self.tracks.get(track)
+        if tiled is None or tiled[1] != width or tiled[0] > count:
+            return 0
+        return tiled[0]
+
+    def version(self):
+        return 0 if self.index is None else self.index['version']
+
+    # tiles can only be used if they were rendered with the same projection as the live map
+    def available(self, zoom, gps, display_width):
+        return (self.index is not None and str(zoom) in self.__tiles
+                and self.index['display_width'] == display_width
+                and self.index['dist_between_latitudes'] == gps.distBetweenLatitudes
+                and self.index['dist_between_longitudes'] == gps.distBetweenLongitudes)
+
+    # draw the tiles inside the width x height rectangle with its top left corner at global pixel (left, top)
+    async def blit(self, fb, zoom, left, top, width, height):
+        size = self.index['tile_size']
+        if self.__buf is None:
+            self.__buf = bytearray(size * size // 4)
+            self.__fb = framebuf.FrameBuffer(self.__buf, size, size, framebuf.GS2_HMSB)
+        tiles = self.__tiles[str(zoom)]
+        for ty in range(top // size, (top + height - 1) // size + 1):
+            for tx in range(left // size, (left + width - 1) // size + 1):
+                name = f'{ty}_{tx}'
+                if name not in tiles:
+                    continue
+                async with OpenFileSafely(f'{TILES_DIR}/{zoom}_{name}', 'rb') as f:
+                    f.readinto(self.__buf)
+                fb.blit(self.__fb, tx * size - left, ty * size - top)
@@ -8,7 +8,6 @@
 # Time Since First Fix
 # Distance/Time to Target
 # More Helper Functions
-# Dynamically limit sentences types to parse
 
 from math import floor, modf
 
@@ -24,7 +23,7 @@ except ImportError:
 
 class MicropyGPS(object):
     """GPS NMEA Sentence Parser. Creates object that stores all relevant GPS data and statistics.
-    Parses sentences one character at a time using update(). """
+    Parses sentences one character at a time using update(), or a whole buffer at a time using update_buffer(). """
 
     # Max Number of Characters a valid sentence can be (based on GGA sentence)
     SENTENCE_LIMIT = 90
@@ -57,12 +56,16 @@ class MicropyGPS(object):
         self.crc_xor = 0
         self.char_count = 0
         self.fix_time = 0
+        self.buffer_tail = b''
+        self.interest = None
+        self.interest_bytes = None
 
         #####################
         # Sentence Statistics
         self.crc_fails = 0
         self.clean_sentences = 0
         self.parsed_sentences = 0
+        self.skipped_sentences = 0
 
         #####################
         # Logging Related
@@ -77,13 +80,14 @@ class MicropyGPS(object):
         self.local_offset = local_offset
 
         # Position/Motion
+        # Speed, course, altitude and geoid height hold the raw segment string until they are first read
         self._latitude = [0, 0.0, 'N']
         self._longitude = [0, 0.0, 'W']
         self.coord_format = location_formatting
-        self.speed = [0.0, 0.0, 0.0]
-        self.course = 0.0
-        self.altitude = 0.0
-        self.geoid_height = 0.0
+        self._speed = [0.0, 0.0, 0.0]
+        self._course = 0.0
+        self._altitude = 0.0
+        self._geoid_height = 0.0
 
         # GPS Info
         self.satellites_in_view = 0
@@ -91,7 +95,8 @@ class MicropyGPS(object):
         self.satellites_used = []
         self.last_sv_sentence = 0
         self.total_sv_sentences = 0
-        self.satellite_data = dict()
+        self._satellite_data = dict()
+        self._pending_sv_segments = []
         self.hdop = 0.0
         self.pdop = 0.0
         self.vdop = 0.0
@@ -128,6 +133,100 @@ class MicropyGPS(object):
         else:
             return self._longitude
 
+    ########################################
+    # Lazily Decoded Fields
+    ########################################
+    @staticmethod
+    def _decode_float(raw):
+        """Convert a raw segment string to float, empty or deformed segments become 0.0"""
+        try:
+            return float(raw) if raw else 0.0
+        except ValueError:
+            return 0.0
+
+    @property
+    def speed(self):
+        """Speed in knots, mph and km/h, decoded from the raw knots segment on first read"""
+        if isinstance(self._speed, str):
+            spd_knt = self._decode_float(self._speed)
+            # Include mph and km/h
+            self._speed = [spd_knt, spd_knt * 1.151, spd_knt * 1.852]
+        return self._speed
+
+    @speed.setter
+    def speed(self, value):
+        self._speed = value
+
+    @property
+    def course(self):
+        """Course over ground in degrees, decoded from the raw segment on first read"""
+        if isinstance(self._course, str):
+            self._course = self._decode_float(self._course)
+        return self._course
+
+    @course.setter
+    def course(self, value):
+        self._course = value
+
+    @property
+    def altitude(self):
+        """Altitude in meters, decoded from the raw segment on first read"""
+        if isinstance(self._altitude, str):
+            self._altitude = self._decode_float(self._altitude)
+        return self._altitude
+
+    @altitude.setter
+    def altitude(self, value):
+        self._altitude = value
+
+    @property
+    def geoid_height(self):
+        """Height of geoid above WGS84 ellipsoid in meters, decoded from the raw segment on first read"""
+        if isinstance(self._geoid_height, str):
+            self._geoid_height = self._decode_float(self._geoid_height)
+        return self._geoid_height
+
+    @geoid_height.setter
+    def geoid_height(self, value):
+        self._geoid_height = value
+
+    @property
+    def satellite_data(self):
+        """Satellite PRN is key, tuple containing (elevation, azimuth, snr) is value. GSV sentences are only
+        stored as segments when parsed, the dict is built here on first read"""
+        for segments in self._pending_sv_segments:
+            self._satellite_data.update(self.decode_gsv_satellites(segments))
+        self._pending_sv_segments = []
+        return self._satellite_data
+
+    @satellite_data.setter
+    def satellite_data(self, value):
+        self._satellite_data = value
+        self._pending_sv_segments = []
+
+    ########################################
+    # Sentence Filtering
+    ########################################
+    def set_interest(self, sentence_ids=None):
+        """
+        Limit parsing to a set of sentence IDs, all other sentences are rejected after their first five characters
+        without building segments or checking the CRC. IDs can be full ('GNRMC') or the type only ('RMC'), which
+        matches every talker in supported_sentences. Passing None parses every supported sentence again.
+        """
+        if sentence_ids is None:
+            self.interest = None
+            self.interest_bytes = None
+            return
+
+        interest = set()
+        for sentence_id in sentence_ids:
+            if len(sentence_id) == 3:
+                interest.update(s for s in self.supported_sentences if s[2:] == sentence_id)
+            else:
+                interest.add(sentence_id)
+        self.interest = interest
+        self.interest_bytes = set(s.encode() for s in interest)
+
     ########################################
     # Logging Related Functions
     ########################################
@@ -234,29 +333,14 @@ class MicropyGPS(object):
             if lon_hemi not in self.__HEMISPHERES:
                 return False
 
-            # Speed
-            try:
-                spd_knt = float(self.gps_segments[7])
-            except ValueError:
-                return False
-
-            # Course
-            try:
-                if self.gps_segments[8]:
-                    course = float(self.gps_segments[8])
-                else:
-                    course = 0.0
-            except ValueError:
-                return False
-
             # TODO - Add Magnetic Variation
 
             # Update Object Data
             self._latitude = [lat_degs, lat_mins, lat_hemi]
             self._longitude = [lon_degs, lon_mins, lon_hemi]
-            # Include mph and hm/h
-            self.speed = [spd_knt, spd_knt * 1.151, spd_knt * 1.852]
-            self.course = course
+            # Speed and Course are decoded when read
+            self._speed = self.gps_segments[7]
+            self._course = self.gps_segments[8]
             self.valid = True
 
             # Update Last Fix Time
@@ -332,15 +416,12 @@ class MicropyGPS(object):
 
     def gpvtg(self):
         """Parse Track Made Good and Ground Speed (VTG) Sentence. Updates speed and course"""
-        try:
-            course = float(self.gps_segments[1]) if self.gps_segments[1] else 0.0
-            spd_knt = float(self.gps_segments[5]) if self.gps_segments[5] else 0.0
-        except ValueError:
+        if len(self.gps_segments) < 6:
             return False
 
-        # Include mph and km/h
-        self.speed = (spd_knt, spd_knt * 1.151, spd_knt * 1.852)
-        self.course = course
+        # Speed and Course are decoded when read
+        self._speed = self.gps_segments[5]
+        self._course = self.gps_segments[1]
         return True
 
     def gpgga(self):
@@ -401,19 +482,12 @@ class MicropyGPS(object):
             if lon_hemi not in self.__HEMISPHERES:
                 return False
 
-            # Altitude / Height Above Geoid
-            try:
-                altitude = float(self.gps_segments[9])
-                geoid_height = float(self.gps_segments[11])
-            except ValueError:
-                altitude = 0
-                geoid_height = 0
-
             # Update Object Data
             self._latitude = [lat_degs, lat_mins, lat_hemi]
             self._longitude = [lon_degs, lon_mins, lon_hemi]
-            self.altitude = altitude
-            self.geoid_height = geoid_height
+            # Altitude / Height Above Geoid are decoded when read
+            self._altitude = self.gps_segments[9]
+            self._geoid_height = self.gps_segments[11]
 
         # Update Object Data
         self.timestamp = [hours, minutes, seconds]
@@ -475,7 +549,8 @@ class MicropyGPS(object):
 
     def gpgsv(self):
         """Parse Satellites in View (GSV) sentence. Updates number of SV Sentences,the number of the last SV sentence
-        parsed, and data on each satellite present in the sentence"""
+        parsed, and queues the sentence so data on each satellite present in it is decoded when satellite_data is
+        read"""
         try:
             num_sv_sentences = int(self.gps_segments[1])
             current_sv_sentence = int(self.gps_segments[2])
@@ -483,6 +558,26 @@ class MicropyGPS(object):
         except ValueError:
             return False
 
+        # Update Object Data
+        self.total_sv_sentences = num_sv_sentences
+        self.last_sv_sentence = current_sv_sentence
+        self.satellites_in_view = sats_in_view
+
+        # For a new set of sentences, we either clear out the existing sat data or
+        # queue additional SV sentences to be merged into it
+        if current_sv_sentence == 1:
+            self.satellite_data = dict()
+        self._pending_sv_segments.append(self.gps_segments)
+
+        return True
+
+    def decode_gsv_satellites(self, segments):
+        """Decode the satellite data held in the segments of one GSV sentence. Returns a dict with satellite PRN as
+        key and a tuple containing telemetry as value"""
+        num_sv_sentences = int(segments[1])
+        current_sv_sentence = int(segments[2])
+        sats_in_view = int(segments[3])
+
         # Create a blank dict to store all the satellite data from this sentence in:
         # satellite PRN is key, tuple containing telemetry is value
         satellite_dict = dict()
@@ -498,24 +593,24 @@ class MicropyGPS(object):
         for sats in range(4, sat_segment_limit, 4):
 
             # If a PRN is present, grab satellite data
-            if self.gps_segments[sats]:
+            if segments[sats]:
                 try:
-                    sat_id = int(self.gps_segments[sats])
+                    sat_id = int(segments[sats])
                 except (ValueError,IndexError):
-                    return False
+                    return dict()
 
                 try:  # elevation can be null (no value) when not tracking
-                    elevation = int(self.gps_segments[sats+1])
+                    elevation = int(segments[sats+1])
                 except (ValueError,IndexError):
                     elevation = None
 
                 try:  # azimuth can be null (no value) when not tracking
-                    azimuth = int(self.gps_segments[sats+2])
+                    azimuth = int(segments[sats+2])
                 except (ValueError,IndexError):
                     azimuth = None
 
                 try:  # SNR can be null (no value) when not tracking
-                    snr = int(self.gps_segments[sats+3])
+                    snr = int(segments[sats+3])
                 except (ValueError,IndexError):
                     snr = None
             # If no PRN is found, then the sentence has no more satellites to read
@@ -525,19 +620,7 @@ class MicropyGPS(object):
             # Add Satellite Data to Sentence Dict
             satellite_dict[sat_id] = (elevation, azimuth, snr)
 
-        # Update Object Data
-        self.total_sv_sentences = num_sv_sentences
-        self.last_sv_sentence = current_sv_sentence
-        self.satellites_in_view = sats_in_view
-
-        # For a new set of sentences, we either clear out the existing sat data or
-        # update it as additional SV sentences are parsed
-        if current_sv_sentence == 1:
-            self.satellite_data = satellite_dict
-        else:
-            self.satellite_data.update(satellite_dict)
-
-        return True
+        return satellite_dict
 
     ##########################################
     # Data Stream Handler Functions
@@ -593,6 +676,13 @@ class MicropyGPS(object):
                 else:
                     self.gps_segments[self.active_segment] += new_char
 
+                    # Reject Sentences Outside the Interest Set as soon as the ID is complete
+                    if self.interest is not None and self.active_segment == 0 and len(self.gps_segments[0]) == 5:
+                        if self.gps_segments[0] not in self.interest:
+                            self.skipped_sentences += 1
+                            self.sentence_active = False
+                            return None
+
                     # When CRC input is disabled, sentence is nearly complete
                     if not self.process_crc:
 
@@ -614,15 +704,7 @@ class MicropyGPS(object):
                 if valid_sentence:
                     self.clean_sentences += 1  # Increment clean sentences received
                     self.sentence_active = False  # Clear Active Processing Flag
-
-                    if self.gps_segments[0] in self.supported_sentences:
-
-                        # parse the Sentence Based on the message type, return True if parse is clean
-                        if self.supported_sentences[self.gps_segments[0]](self):
-
-                            # Let host know that the GPS object was updated by returning parsed sentence type
-                            self.parsed_sentences += 1
-                            return self.gps_segments[0]
+                    return self.parse_segments()
 
                 # Check that the sentence buffer isn't filling up with Garage waiting for the sentence to complete
                 if self.char_count > self.SENTENCE_LIMIT:
@@ -631,6 +713,96 @@ class MicropyGPS(object):
         # Tell Host no new sentence was parsed
         return None
 
+    def update_buffer(self, buf):
+        """Process a whole buffer of received bytes (bytes, bytearray or memoryview) one sentence at a time.
+        Each sentence is located by its '$' and '*' delimiters, validated by CRC over the slice and split into
+        segments once, instead of being fed through update() character by character. An incomplete sentence at
+        the end of the buffer is kept and completed by the next call. Returns a list of the sentence types that
+        were parsed successfully"""
+
+        parsed = []
+
+        # Prepend Incomplete Sentence From Previous Buffer
+        if self.buffer_tail:
+            buf = self.buffer_tail + buf
+            self.buffer_tail = b''
+        elif not isinstance(buf, bytes):
+            buf = bytes(buf)
+
+        # Write Raw Data to log file if enabled
+        if self.log_en:
+            try:
+                self.write_log(buf.decode('ascii'))
+            except UnicodeError:
+                pass
+
+        end = len(buf)
+        start = buf.find(b'$')
+        while start != -1:
+            self.char_count = 0
+
+            # Reject Sentences Outside the Interest Set Before Looking For the CRC or Building Segments
+            if self.interest_bytes is not None and start + 6 <= end and \
+                    buf[start + 1:start + 6] not in self.interest_bytes:
+                self.skipped_sentences += 1
+                start = buf.find(b'$', start + 1)
+                continue
+
+            # Find End of Sentence, Keep It for Next Buffer if the CRC Has Not Arrived Yet
+            star = buf.find(b'*', start + 1, start + self.SENTENCE_LIMIT)
+            next_start = buf.find(b'$', start + 1, star if star != -1 else end)
+            if next_start != -1:  # Sentence Was Cut Off By a New One
+                start = next_start
+                continue
+            if star == -1 or star + 3 > end:
+                if end - start <= self.SENTENCE_LIMIT:
+                    self.buffer_tail = buf[start:]
+                break
+
+            # Validate CRC over the Sentence Body
+            crc_xor = 0
+            for i in range(start + 1, star):
+                crc_xor ^= buf[i]
+            try:
+                final_crc = int(buf[star + 1:star + 3], 16)
+            except ValueError:  # CRC Value was deformed and could not have been correct
+                final_crc = -1
+            if crc_xor != final_crc:
+                self.crc_fails += 1
+                start = buf.find(b'$', star)
+                continue
+
+            # Split Sentence Into Segments Once
+            try:
+                self.gps_segments = buf[start + 1:star].decode('ascii').split(',')
+            except UnicodeError:
+                start = buf.find(b'$', star)
+                continue
+            self.gps_segments.append(buf[star + 1:star + 3].decode('ascii'))
+            self.clean_sentences += 1
+
+            sentence_type = self.parse_segments()
+            if sentence_type is not None:
+                parsed.append(sentence_type)
+            start = buf.find(b'$', star)
+
+        self.sentence_active = False
+        return parsed
+
+    def parse_segments(self):
+        """Parse the Clean Sentence Stored in gps_segments if it's a supported sentence. Returns sentence type on
+        successful parse, None otherwise"""
+        if self.gps_segments[0] in self.supported_sentences:
+
+            # parse the Sentence Based on the message type, return True if parse is clean
+            if self.supported_sentences[self.gps_segments[0]](self):
+
+                # Let host know that the GPS object was updated by returning parsed sentence type
+                self.parsed_sentences += 1
+                return self.gps_segments[0]
+
+        return None
+
     def new_fix_time(self):
         """Updates a high resolution counter with current time when fix is updated. Currently only triggered from
         GGA, GSA and RMC sentences"""
@@ -660,6 +832,15 @@ class MicropyGPS(object):
         """
         self.last_sv_sentence = 0
 
+    def latlong(self):
+        """
+        Returns the current position in signed decimal degrees
+        :return: tuple (latitude, longitude)
+        """
+        lat = (self._latitude[0] + self._latitude[1] / 60) * (1 if self._latitude[2] == 'N' else -1)
+        long = (self._longitude[0] + self._longitude[1] / 60) * (1 if self._longitude[2] == 'E' else -1)
+        return lat, long
+
     def satellites_visible(self):
         """
         Returns a list of of the satellite PRNs currently visible to the receiver
@@ -1,7 +1,7 @@
 import os
-from machine import Pin
+from array import array
 import utime
-from _thread import start_new_thread
+from _thread import start_new_thread, allocate_lock
 try:
     import uasyncio as asyncio
 except ImportError:
@@ -11,22 +11,64 @@ import framebuf
 from epaper import EPD_2in7
 from my_gps_utils import GPS
 from onboard_led import led, flash_led
-from file_utils import OpenFileSafely, TrackReader, file_exists
+from file_utils import OpenFileSafely, TrackStream, file_exists
+from track_index import TrackIndex
+import raster
+import image_format
+from job_queue import Job, JobQueue, PRIORITY_HIGH, PRIORITY_NORMAL
+from buttons import Buttons, SHORT, LONG, REPEAT
+from track_lod import TrackLOD
+from projection import Projection, MAX_POINTS_OUT
 
+# a full refresh is done after this many partial refreshes to clear ghosting
+MAX_PARTIAL_REFRESHES = 10
+# grid in pixels the zoomed in map's level of detail cache is anchored to
+LOD_ANCHOR_GRID = 1024
+# seconds a marker image is shown for, unless a key is pressed
+MARKER_IMG_VIEWING_DURATION = 15
+
+# Memory budget of the display in bytes, a framebuffer being 176 * 264 / 4 = 11616:
+#   back buffer (epd.buffer_4Gray)               11616, in initialize()
+#   front buffer                                 11616, in initialize()
+#   gray planes (epd.plane_10 and plane_13)      11616, in initialize()
+#   base layer                                   11616, when the first map is drawn
+#   row hashes                                    2112
+#   level of detail cache (TrackLOD)          <= 32000, grows with the cached tracks up to track_lod.MAX_POINTS
+# About 80 KB in all, what's left of the heap has to do for everything else, e.g. uploads to the web server
 class EPD():
     def __init__(self):
         self.epd = None
         self.width = 176
         self.height = 264
-        self.__epd_thread_queue = []
-        self.key0 = Pin(15, Pin.IN, Pin.PULL_UP)
-        self.key1 = Pin(17, Pin.IN, Pin.PULL_UP)
-        self.key2 = Pin(2,  Pin.IN, Pin.PULL_UP)
+        self.__jobs = JobQueue()
+        # mailbox of the core 1 worker, holds the job it should run next
+        self.__mailbox = None
+        self.__mailbox_lock = allocate_lock()
+        self.__core1_done = asyncio.ThreadSafeFlag()
+        self.__core1_busy = False
+        # Frames are double buffered: drawing goes to the epd's buffer_4Gray/image4Gray (the back buffer) while
+        # core 1 writes the front buffer to the display, present() swaps them
+        self.__front_buffer = None
+        self.__front_image = None
+        self.buttons = Buttons((15, 17, 2))
+        self.key0, self.key1, self.key2 = self.buttons.keys
         self.__key0_shortpress_func = None
         self.__key1_shortpress_func = None
         self.__key2_shortpress_func = None
-        self.__EPD_READY = asyncio.Event()
-        self.__EPD_READY.set()
+        # copy of the last rendered map without the current position, and the view and data it was rendered for
+        self.__base_layer = None
+        self.__base_layer_key = None
+        self.__track_lod = TrackLOD()
+        # name of the screen on the display and the rectangles (x, y, w, h) of it changed since it was last written,
+        # None if the whole display has to be refreshed
+        self.__screen = None
+        self.__dirty = None
+        self.__partial_refreshes = 0
+        self.__tracking_info_lines = None
+        self.__position_rect = None
+        # row hashes of the frame on the display (None if unknown) and of the frame being written
+        self.__frame_hashes = None
+        self.__new_frame_hashes = array('I', [0] * self.height)
 
     def initialize(self, key0_shortpress_func, key0_longpress_func, key1_shortpress_func, key1_longpress_func, key2_shortpress_func, key2_longpress_func): # functions should be async
         self.__key0_shortpress_func = key0_shortpress_func
@@ -36,128 +78,215 @@ class EPD():
         self.__key2_shortpress_func = key2_shortpress_func
         self._key2_longpress_func = key2_longpress_func
         self.epd = EPD_2in7()
+        self.__front_buffer = bytearray(len(self.epd.buffer_4Gray))
+        self.__front_image = framebuf.FrameBuffer(self.__front_buffer, self.width, self.height, framebuf.GS2_HMSB)
         print('e-Paper ready!')
         
-    async def manage_threads(self):
-        async def async_thread_func(func, args):
-            self.__EPD_READY.clear()
-            await func(*args)
-            self.__EPD_READY.set()
-        def sync_thread_func(func, args):
-            self.__EPD_READY.clear()
-            func(*args)
-            self.__EPD_READY.set()
+    # Run queued e-Paper jobs one at a time, forever. Async jobs (drawing) run on core 0 since they use asyncio and
+    # the file locks, sync jobs (initialization) are passed to a worker on core 1 and waited for.
+    # Frames are written to the display by the core 1 worker too (see present()), but not waited for, so the next
+    # job can draw while the panel refreshes
+    async def run_jobs(self):
+        start_new_thread(self.__core1_worker, ())
         while 1:
-            if len(self.__epd_thread_queue) == 0:
-                await asyncio.sleep(0.2)
+            job = self.__jobs.get()
+            if job is None:
+                await self.__jobs.ready.wait()
                 continue
-            await self.__EPD_READY.wait()
-            await asyncio.sleep(0.1) # give time for thread to exit
-            func, args, is_async = self.__epd_thread_queue.pop(0)
-            print('Running e-paper function in thread. Queue length:', len(self.__epd_thread_queue))
-            if is_async:
-                start_new_thread(asyncio.create_task, (async_thread_func(func, args),))
-            else:
-                start_new_thread(sync_thread_func, (func, args))
-
-    # priority argument should only be used by functions in the EPD class. It is used
-    # to make sure write_buffer_to_display() is called directly after running an EPD function
-    def run_in_thread(self, func: function, args=tuple(), is_async=True, priority=False):
-        queue_obj = (func, args, is_async)
-        if priority:
-            self.__epd_thread_queue.insert(0, queue_obj)
-        else:
-            self.__epd_thread_queue.append(queue_obj)
-        print('Added function to e-paper thread queue of length', len(self.__epd_thread_queue))
+            print('Running e-paper job', job.func.__name__)
+            try:
+                if job.is_async:
+                    await job.func(*job.args)
+                else:
+                    await self.__post(job)
+                    await self.__core1_idle()
+            except Exception as e:
+                print('e-Paper job', job.func.__name__, 'failed:', e)
+                # the job won't present its frame, don't leave anyone waiting for it
+                if job.dropped_flag is not None:
+                    job.dropped_flag.set()
+
+    def __core1_worker(self):
+        while 1:
+            with self.__mailbox_lock:
+                job = self.__mailbox
+                self.__mailbox = None
+            if job is None:
+                utime.sleep_ms(10)
+                continue
+            try:
+                job.func(*job.args)
+            except Exception as e:
+                print('e-Paper job', job.func.__name__, 'failed:', e)
+            self.__core1_busy = False
+            self.__core1_done.set()
+
+    async def __core1_idle(self):
+        while self.__core1_busy:
+            await self.__core1_done.wait()
 
+    # pass a job to the core 1 worker once it is done with the previous one
+    async def __post(self, job):
+        await self.__core1_idle()
+        with self.__mailbox_lock:
+            self.__core1_busy = True
+            self.__mailbox = job
+
+    # Queue a function to run as an e-Paper job.
+    # priority should only be used by functions in the EPD class, to run them before other queued jobs.
+    # Queueing a job with a key drops the queued job with the same key, e.g. an outdated map.
+    # dropped_flag is set if the job is dropped, cancelled or fails instead of running, for callers waiting on it
+    def queue_job(self, func: function, args=tuple(), is_async=True, priority=False, key=None, dropped_flag=None):
+        self.__jobs.put(Job(func, args, is_async, PRIORITY_HIGH if priority else PRIORITY_NORMAL, key, dropped_flag))
+
+    # drop queued jobs with these keys
+    def cancel_jobs(self, *keys):
+        self.__jobs.cancel(*keys)
+
+    # Run the key press functions for the key events, forever
     async def key_listener(self):
-        sleepInterval = 0.3
+        asyncio.create_task(self.buttons.run())
+        events = self.buttons.listen()
+        funcs = {
+            (0, SHORT): self.__key0_shortpress_func,
+            (0, LONG): self._key0_longpress_func,
+            (1, SHORT): self.__key1_shortpress_func,
+            (1, LONG): self._key1_longpress_func,
+            (2, SHORT): self.__key2_shortpress_func,
+            (2, LONG): self._key2_longpress_func,
+        }
         while 1:
-            
-            if self.key0.value() == 0:
-                print('Key 0 pressed')
-                await flash_led(3)
-                if self.key0.value() == 0:
-                    # run long press task
-                    utime.sleep(sleepInterval)
-                    await flash_led(3)
-                    asyncio.create_task(self._key0_longpress_func())
-                else:
-                    # run short press task
-                    asyncio.create_task(self.__key0_shortpress_func())
-                    
-            if self.key1.value() == 0:
-                print('Key 1 pressed')
-                await flash_led(3)
-                if self.key1.value() == 0:
-                    # run long press task
-                    utime.sleep(sleepInterval)
-                    await flash_led(3)
-                    asyncio.create_task(self._key1_longpress_func())
-                else:
-                    # run short press task
-                    asyncio.create_task(self.__key1_shortpress_func())
-                    
-            if self.key2.value() == 0:
-                print('Key 2 pressed')
-                await flash_led(3)
-                if self.key2.value() == 0:
-                    # run long press task
-                    utime.sleep(sleepInterval)
-                    await flash_led(3)
-                    asyncio.create_task(self._key2_longpress_func())
-                else:
-                    # run short press task
-                    asyncio.create_task(self.__key2_shortpress_func())
-            await asyncio.sleep(sleepInterval)
+            key, event = await events.get()
+            if event == REPEAT:
+                continue
+            print(f'Key {key} pressed ({event})')
+            asyncio.create_task(flash_led(1 if event == SHORT else 2))
+            asyncio.create_task(funcs[(key, event)]())
 
 
     ### Miscellaneous functions ###
 
-    # use buttons to select something
-    def button_select(self, initial_val: int, min_val: int = 1, max_val: int = 10, on_change_callback: function = lambda x: x):
-        # this function is intentionally asyncio-blocking
-        curr_val = initial_val
-        utime.sleep(0.5)
-        led.on()
-        utime.sleep(0.3)
-        def indicate_curr_val():
-            for i in range(curr_val):
-                led.off()
-                utime.sleep(0.15)
-                led.on()
-                utime.sleep(0.15)
-            on_change_callback(curr_val)
-            utime.sleep(max(0.2, 0.5-curr_val/10))
-        indicate_curr_val()
-        while 1:
-            if self.key0.value() == 0:
-                curr_val = max(min_val, curr_val - 1)
-                indicate_curr_val()
-            elif self.key1.value() == 0:
-                led.off()
-                utime.sleep(0.5)
-                return curr_val
-            elif self.key2.value() == 0:
-                curr_val = min(max_val, curr_val + 1)
-                indicate_curr_val()
-
-    # Write epd buffer to the display, takes around ~6 seconds
-    # You may pass an asyncio flag to the finished_flag argument if desired
-    # Case 1: function is called from an AYSNCHRONOUS function
-    #   Asyncio tasks on CORE0 will be blocked until function finishes
-    # Case 2: function is called from a SYNCHRONOUS function
-    #   Case 2a: If called from CORE0, will block asyncio tasks until finished
-    #   Case 2b: If called from CORE1, will not block CORE0 asyncio tasks
-    # To avoid blocking asyncio tasks: use self.run_in_thread(self.write_buffer_to_display)
-    def write_buffer_to_display(self, finished_flag: asyncio.ThreadSafeFlag=None):
-        self.epd.EPD_2IN7_4Gray_Display(self.epd.buffer_4Gray)
+    # Use buttons to select something: key 0 decreases the value, key 2 increases it (repeatedly while held) and
+    # key 1 confirms it. The led blinks the current value. Other tasks keep running while selecting
+    async def button_select(self, initial_val: int, min_val: int = 1, max_val: int = 10, on_change_callback: function = lambda x: x):
+        events = self.buttons.listen()
+        try:
+            curr_val = initial_val
+            led.on()
+            await asyncio.sleep(0.3)
+            async def indicate_curr_val():
+                for i in range(curr_val):
+                    led.off()
+                    await asyncio.sleep(0.15)
+                    led.on()
+                    await asyncio.sleep(0.15)
+                on_change_callback(curr_val)
+            await indicate_curr_val()
+            while 1:
+                key, event = await events.get()
+                if key == 1:
+                    led.off()
+                    return curr_val
+                elif key == 0:
+                    curr_val = max(min_val, curr_val - 1)
+                elif key == 2:
+                    curr_val = min(max_val, curr_val + 1)
+                await indicate_curr_val()
+        finally:
+            self.buttons.stop_listening(events)
+
+    # Show the frame drawn into the back buffer: once the previous frame is written, the buffers are swapped and the
+    # core 1 worker writes the new front buffer to the display while the caller goes on (e.g. drawing the next frame).
+    # You may pass an asyncio flag to the finished_flag argument, it is set once the frame is on the display
+    async def present(self, finished_flag: asyncio.ThreadSafeFlag=None):
+        await self.__core1_idle()
+        self.epd.buffer_4Gray, self.__front_buffer = self.__front_buffer, self.epd.buffer_4Gray
+        self.epd.image4Gray, self.__front_image = self.__front_image, self.epd.image4Gray
+        await self.__post(Job(self.__write_front_buffer, (self.__dirty, finished_flag), False, PRIORITY_HIGH, None, None))
+        self.__dirty = []
+
+    # Write the front buffer to the display on core 1, mostly waiting for the panel to refresh.
+    # Only the dirty rectangles are refreshed (in black and white) if the display already shows the same screen
+    # (dirty is None otherwise) and they're black and white, e.g. text and the position marker. Rows are compared
+    # with the frame on the display, writing is skipped if nothing changed
+    def __write_front_buffer(self, dirty, finished_flag):
+        changed = self.__changed_rows(self.__front_buffer)
+        if not any(changed) and self.__partial_refreshes < MAX_PARTIAL_REFRESHES:
+            print('e-Paper frame unchanged, skipping refresh')
+        else:
+            rects = None
+            if dirty is not None and self.__partial_refreshes < MAX_PARTIAL_REFRESHES:
+                rects = self.__partial_rects(dirty, changed)
+                # grays would come out black or white until the next full refresh
+                if any(raster.has_gray(self.__front_buffer, self.width, self.height, *rect) for rect in rects):
+                    rects = None
+            if rects is None:
+                self.epd.EPD_2IN7_4Gray_Display(self.__front_buffer)
+                self.__partial_refreshes = 0
+            else:
+                for rect in rects:
+                    self.epd.display_partial(*rect, self.__front_buffer)
+                self.__partial_refreshes += 1
+        self.__new_frame_hashes, self.__frame_hashes = self.__frame_hashes, self.__new_frame_hashes
+        if self.__new_frame_hashes is None:
+            self.__new_frame_hashes = array('I', [0] * self.height)
         if finished_flag is not None:
             finished_flag.set()
 
+    # Called by functions drawing to the buffer, with the name of the screen they draw (None if it can't be
+    # updated partially). Returns True if the display already shows that screen, so only the changed parts have to be
+    # marked dirty. Otherwise the next frame presented refreshes the whole display
+    def begin_screen(self, screen):
+        if screen is None or screen != self.__screen:
+            self.__screen = screen
+            self.__dirty = None
+            return False
+        return True
+
+    def mark_dirty(self, x, y, w, h):
+        if self.__dirty is not None:
+            self.__dirty.append((x, y, w, h))
+
+    # refresh the whole display on the next present()
+    def invalidate(self):
+        self.__dirty = None
+
+    # flags for the rows of buf that differ from the frame on the display
+    def __changed_rows(self, buf):
+        raster.row_hashes(buf, self.width, self.height, self.__new_frame_hashes)
+        if self.__frame_hashes is None:
+            return bytearray(b'\x01' * self.height)
+        changed = bytearray(self.height)
+        for row in range(self.height):
+            if self.__new_frame_hashes[row] != self.__frame_hashes[row]:
+                changed[row] = 1
+        return changed
+
+    # The dirty rectangles with changed rows in them, plus full width bands of the changed rows none of them cover.
+    # Changes in the rows of a dirty rectangle are assumed to be inside it
+    def __partial_rects(self, dirty, changed):
+        rects = []
+        covered = bytearray(self.height)
+        for x, y, w, h in dirty:
+            y0 = max(0, y)
+            y1 = min(self.height, y + h)
+            if any(changed[y0:y1]):
+                rects.append((x, y, w, h))
+                for row in range(y0, y1):
+                    covered[row] = 1
+        start = None
+        for row in range(self.height + 1):
+            uncovered = row < self.height and changed[row] and not covered[row]
+            if uncovered and start is None:
+                start = row
+            elif not uncovered and start is not None:
+                rects.append((0, start, self.width, row - start))
+                start = None
+        return rects
+
     # display tracking information while recording trails
     async def display_tracking_info(self, currTime, recordingDuration, timeSinceLastPoint, newPoints, numPointsTotal, trailWidth):
-        self.run_in_thread(self.write_buffer_to_display, is_async=False, priority=True)
+        partial = self.begin_screen('tracking_info')
         h=5
         self.epd.image4Gray.fill(self.epd.white)
         output = 'Current time\n'
@@ -172,16 +301,20 @@ class EPD():
         output += str(numPointsTotal) + '\n'
         output += 'Current trail width\n'
         output += f'{trailWidth} meters'
-        for i, line in enumerate(output.split('\n')):
-            if i%2:
-                self.epd.image4Gray.text(line, 5, h, self.epd.darkgray)
-            else:
-                self.epd.image4Gray.text(line, 5, h, self.epd.black)
+        lines = output.split('\n')
+        # black only, so changed lines can be refreshed partially
+        for i, line in enumerate(lines):
+            self.epd.image4Gray.text(line, 5, h, self.epd.black)
+            # only refresh the lines that changed
+            if partial and line != self.__tracking_info_lines[i]:
+                self.mark_dirty(0, h, self.width, 8)
             h += 13
+        self.__tracking_info_lines = lines
+        await self.present()
 
-    async def draw_trails(self, gps: GPS, map_properties, finished_flag: asyncio.ThreadSafeFlag):
-        self.run_in_thread(self.write_buffer_to_display, args=(finished_flag,), is_async=False, priority=True)
-        # transformation functions from (lat, long) to (x, y) coordinates
+    # data_version changes whenever tracks, junctions or markers change
+    async def draw_trails(self, gps: GPS, map_properties, track_index: TrackIndex, data_version, finished_flag: asyncio.ThreadSafeFlag):
+        # projection from (lat, long) to (x, y) coordinates
         currZoom = map_properties['zoom']['levels'][map_properties['zoom']['current']]
         scalingFactor = None
         if currZoom == 'fit':
@@ -194,102 +327,176 @@ class EPD():
         else:
             scalingFactor = self.width / currZoom
 
-        def scale(lat, long):
-            lat = gps.latToMeters(lat)
-            long = gps.longToMeters(long)
-            y = self.height - (lat - map_properties['bounds']['bottom']) * scalingFactor
-            x = (long - map_properties['bounds']['left']) * scalingFactor
-            return x, y
-        
+        # When zoomed in, the map is centered on the current coords snapped to a grid of a quarter of the map
+        # width, so the base layer (trails, junctions, markers) stays the same while moving around inside a cell
         currLatlong = gps.latlong()
-        currPos = scale(*currLatlong)
-        # center map on current coords
-        def translate(x, y):
-            if currZoom != 'fit':
-                x += self.width/2 - currPos[0]
-                y += self.height/2 - currPos[1]
-            return x, y
-        
-        def transform(lat, long):
-            x, y = scale(lat, long)
-            x, y = translate(x, y)
-            return int(x), int(y)
+        centerLatlong = None
+        origin = None
+        if currZoom == 'fit':
+            # bottom left corner of the map at the bottom left of the display, everything on it is within 320 pixels
+            bottom = round(map_properties['bounds']['bottom'] / gps.distBetweenLatitudes * 1e6)
+            left = round(map_properties['bounds']['left'] / gps.distBetweenLongitudes * 1e6)
+            view = Projection(bottom, left, 0, self.height, scalingFactor,
+                              gps.distBetweenLatitudes, gps.distBetweenLongitudes, clamp=320)
+        else:
+            gridLat = currZoom / 4 / gps.distBetweenLatitudes
+            gridLong = currZoom / 4 / gps.distBetweenLongitudes
+            origin = (round(currLatlong[0] / gridLat), round(currLatlong[1] / gridLong))
+            centerLatlong = (origin[0] * gridLat, origin[1] * gridLong)
+            # center map on snapped current coords
+            view = Projection(round(centerLatlong[0] * 1e6), round(centerLatlong[1] * 1e6), self.width // 2,
+                              self.height // 2, scalingFactor, gps.distBetweenLatitudes, gps.distBetweenLongitudes)
+
+        # the base layer only has to be rendered again if the view or any tracks, junctions or markers changed
+        key = (currZoom, origin, data_version)
+        self.begin_screen('map')
+        if key == self.__base_layer_key:
+            self.epd.buffer_4Gray[:] = self.__base_layer
+        else:
+            self.invalidate()
+            await self.draw_base_layer(gps, map_properties, track_index, view, currZoom, centerLatlong)
+            if self.__base_layer is None:
+                self.__base_layer = bytearray(len(self.epd.buffer_4Gray))
+            self.__base_layer[:] = self.epd.buffer_4Gray
+            self.__base_layer_key = key
+
+        # draw current position
+        currPos = view.point(*currLatlong)
+        self.epd.image4Gray.line(currPos[0]-4, currPos[1], currPos[0]+4, currPos[1], self.epd.black)
+        self.epd.image4Gray.line(currPos[0], currPos[1]-4, currPos[0], currPos[1]+4, self.epd.black)
+        self.epd.image4Gray.ellipse(*currPos, 3, 3, self.epd.black)
+        # if only the position changed, only its old and new position have to be refreshed
+        rect = (currPos[0]-4, currPos[1]-4, 9, 9)
+        if rect != self.__position_rect:
+            if self.__position_rect is not None:
+                self.mark_dirty(*self.__position_rect)
+            self.mark_dirty(*rect)
+            self.__position_rect = rect
+
+        # info text
+        if currZoom == 'fit':
+            currZoom = round(map_properties["width"])
+        self.epd.image4Gray.text(f'Map width: {currZoom}m', 5, 5, self.epd.darkgray)
+        await self.present(finished_flag)
+
+    # draw trails, junctions and markers, everything on the map except for the current position and info text
+    async def draw_base_layer(self, gps: GPS, map_properties, track_index: TrackIndex, view: Projection, currZoom, centerLatlong):
+        # when zoomed in, only read the parts of tracks inside the viewport (plus a margin) using the tile index
+        # viewport is [top, bottom, left, right] in microdegrees
+        viewport = None
+        if currZoom != 'fit':
+            margin = 1.25
+            halfWidth = currZoom / 2 * margin / gps.distBetweenLongitudes
+            halfHeight = currZoom * self.height / self.width / 2 * margin / gps.distBetweenLatitudes
+            viewport = [int((centerLatlong[0] + halfHeight) * 1e6), int((centerLatlong[0] - halfHeight) * 1e6),
+                        int((centerLatlong[1] - halfWidth) * 1e6), int((centerLatlong[1] + halfWidth) * 1e6)]
         
-        # get and draw tracks in subsets by trail width, descending
-        # dilate_image is applied after each subset is drawn to achieve drawing line thickness
-        tracks = map_properties['tracks'].keys()
-        maxWidth = 0
-        for track in tracks:
-            w = map_properties['tracks'][track]['width']
-            if w > maxWidth:
-                maxWidth = w
-        widthRange = [i for i in range(1, maxWidth+1)]
-        widthRange.reverse()
         self.epd.image4Gray.fill(self.epd.white)
-        for currWidth in widthRange:
-            tracks_subset = [track for track in tracks if map_properties['tracks'][track]['width'] == currWidth]
-            # draw tracks
-            for track in tracks_subset:
-                prev = None
-                curr = None
-                async for lat, long in TrackReader(track):
-                    curr = transform(lat, long)
-                    # draw line
-                    if prev is not None:
-                        # skip if point is too close to prev
-                        dist = ((curr[0] - prev[0]) ** 2 + (curr[1] - prev[1]) ** 2) ** (1/2)
-                        if dist >= 2:
-                            self.epd.image4Gray.line(*prev, *curr, self.epd.black)
-                            prev = curr
-                    else:
-                        prev = curr
-                self.epd.image4Gray.line(*prev, *curr, self.epd.black)
-                await asyncio.sleep(0)
-            if currWidth != 1:
-                self.dilate_image(self.epd.black)
+
+        # Projection of the simplified tracks in the level of detail cache. At 'fit' it's the view's. When zoomed in,
+        # tracks are cached in pixels from an anchor on a grid of LOD_ANCHOR_GRID pixels and moved to the view, so
+        # the cache stays valid while the map moves around the anchor
+        tiles = map_properties['tiles']
+        tileMode = False
+        if currZoom == 'fit':
+            lodProjection = view
+            lodKey = ('fit', view.lat0, view.long0, view.kx, view.ky)
+            offsetX = 0
+            offsetY = 0
+        else:
+            scalingFactor = self.width / currZoom
+            gridLat = LOD_ANCHOR_GRID / scalingFactor / gps.distBetweenLatitudes
+            gridLong = LOD_ANCHOR_GRID / scalingFactor / gps.distBetweenLongitudes
+            anchor = (round(centerLatlong[0] / gridLat), round(centerLatlong[1] / gridLong))
+            anchorLat = round(anchor[0] * gridLat * 1e6)
+            anchorLong = round(anchor[1] * gridLong * 1e6)
+            lodProjection = Projection(anchorLat, anchorLong, 0, 0, scalingFactor,
+                                       gps.distBetweenLatitudes, gps.distBetweenLongitudes)
+            lodKey = (currZoom, gps.distBetweenLongitudes, anchor)
+            offsetX, offsetY = view.point_udeg(anchorLat, anchorLong)
+            # tile mode: blit the pre-rendered tiles of the visible area, and only draw what isn't in them live
+            if tiles.available(currZoom, gps, self.width):
+                left = round(gps.longToMeters(centerLatlong[1]) * scalingFactor - self.width / 2)
+                top = round(-gps.latToMeters(centerLatlong[0]) * scalingFactor - self.height / 2)
+                await tiles.blit(self.epd.image4Gray, currZoom, left, top, self.width, self.height)
+                tileMode = True
+        self.__track_lod.prune(map_properties['tracks'])
+
+        # draw tracks, each as thick polylines with a radius of (trail width - 1) pixels, clipped to the display
+        # plus a margin. Tracks are drawn from the level of detail cache, tracks too large for it are read from
+        # their files: points are projected a batch at a time into xs, ys, after the last point of the previous batch
+        batchSize = 64
+        xs = array('h', [0] * (MAX_POINTS_OUT * batchSize + 1))
+        ys = array('h', [0] * (MAX_POINTS_OUT * batchSize + 1))
+        prev = array('i', [0, 0, 0])
+        for track, properties in map_properties['tracks'].items():
+            # records already in the tiles, only the rest of the track is drawn, from the last tiled point on
+            count = track_index.count(track)
+            tiled = tiles.tiled_records(track, count, properties['width']) if tileMode else 0
+            if tiled and tiled == count:
+                continue
+            radius = properties['width'] - 1
+            margin = radius + 2
+            clip = (-margin, -margin, self.width - 1 + margin, self.height - 1 + margin)
+            if not tiled:
+                lod = await self.__track_lod.get(track, lodKey, track_index.version(track), lodProjection)
+                if lod is not None:
+                    raster.polyline(self.epd.image4Gray, lod[0], lod[1], len(lod[0]), self.epd.black, radius,
+                                    offsetX, offsetY, clip)
+                    await asyncio.sleep(0)
+                    continue
+            ranges = None if viewport is None else track_index.ranges(track, viewport)
+            if tiled:
+                ranges = [[tiled - 1, count]] if ranges is None else [
+                    [max(start, tiled - 1), end] for start, end in ranges if end > tiled - 1]
+            async with TrackStream(track, batch_size=batchSize, ranges=ranges) as stream:
+                numPoints = 0
+                nextRecord = 0
+                prev[0] = 0
+                async for lats, longs, n in stream:
+                    # don't connect points across a gap between ranges
+                    if stream.batch_start != nextRecord:
+                        numPoints = 0
+                        prev[0] = 0
+                    nextRecord = stream.batch_start + n
+                    numPoints = raster.simplify(xs, ys, view.project(lats, longs, n, xs, ys, numPoints, prev))
+                    raster.polyline(self.epd.image4Gray, xs, ys, numPoints, self.epd.black, radius, clip=clip)
+                    if numPoints:
+                        xs[0] = xs[numPoints-1]
+                        ys[0] = ys[numPoints-1]
+                        numPoints = 1
+            await asyncio.sleep(0)
+
+        # only look up junctions and markers inside the viewport when zoomed in
+        if viewport is None:
+            junctions = map_properties['junctions']
+            markers = map_properties['markers']
+        else:
+            bbox = [v / 1e6 for v in viewport]
+            junctions = map_properties['junction_index'].in_bbox(*bbox)
+            markers = map_properties['marker_index'].in_bbox(*bbox)
 
         # draw junctions
-        for junction in map_properties['junctions']:
-            x, y = transform(junction['lat'], junction['long'])
+        for junction in junctions:
+            x, y = view.point(junction['lat'], junction['long'])
             self.epd.image4Gray.ellipse(x, y, 5, 5, self.epd.white, True)
             self.epd.image4Gray.ellipse(x, y, 5, 5, self.epd.lightgray)
             self.epd.image4Gray.text('x', x-4, y-4, self.epd.lightgray)
 
         # draw markers
-        for marker in map_properties['markers']:
-            x, y = transform(marker['lat'], marker['long'])
+        for marker in markers:
+            x, y = view.point(marker['lat'], marker['long'])
             self.epd.image4Gray.ellipse(x, y, 5, 5, self.epd.white, True)
             self.epd.image4Gray.ellipse(x, y, 5, 5, self.epd.darkgray)
             self.epd.image4Gray.text('i', x-4, y-3, self.epd.darkgray)
-        
-        # draw current position
-        currPos = transform(*currLatlong)
-        self.epd.image4Gray.line(currPos[0]-4, currPos[1], currPos[0]+4, currPos[1], self.epd.black)
-        self.epd.image4Gray.line(currPos[0], currPos[1]-4, currPos[0], currPos[1]+4, self.epd.black)
-        self.epd.image4Gray.ellipse(*currPos, 3, 3, self.epd.black)
 
-        # info text
-        if currZoom == 'fit':
-            currZoom = round(map_properties["width"])
-        self.epd.image4Gray.text(f'Map width: {currZoom}m', 5, 5, self.epd.darkgray)
-
-    def dilate_image(self, color):
-        pointsBuffer = []
-        def draw_kernel(x, y):
-            self.epd.image4Gray.pixel(x+1, y, color)
-            self.epd.image4Gray.pixel(x-1, y, color)
-            self.epd.image4Gray.pixel(x, y+1, color)
-            self.epd.image4Gray.pixel(x, y-1, color)
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.epd.image4Gray.pixel(x, y) != 0b11: # if pixel not white
-                    pointsBuffer.append((x, y))
-                while len(pointsBuffer) and pointsBuffer[0][0] < x-2:
-                    draw_kernel(*pointsBuffer.pop(0))
-        for p in pointsBuffer:
-            draw_kernel(*p)
+    # Grow every non-white pixel by radius pixels in color, works on the buffer's bytes directly.
+    # Thickens everything drawn so far at once, tracks are drawn thick with raster.polyline() instead
+    def dilate_image(self, color, radius=1):
+        raster.dilate(self.epd.buffer_4Gray, self.width, self.height, color, radius)
 
     async def view_markers(self, gps: GPS, markers, finished_flag: asyncio.ThreadSafeFlag):
+        self.begin_screen(None)
         self.epd.image4Gray.fill(self.epd.white)
         currLatlong = gps.latlong()
         h = 5
@@ -321,28 +528,31 @@ class EPD():
             for part in textParts:
                 h += 13
                 self.epd.image4Gray.text(part, 5, h, self.epd.darkgray)
-        self.write_buffer_to_display(finished_flag)
+        await self.present(finished_flag)
 
     async def view_marker_img(self, marker: str):
         print('viewing marker:', marker['id'])
-        buf_index = 0
-        chunk_size = 32 # max possible chunk size is 32
         file = 'marker_imgs/'+marker['id']
         if not await file_exists(file):
             print('No image associated with marker ID', marker['id'])
             await flash_led(2)
             return
+        self.begin_screen(None)
+        # raw or packbits compressed, read straight into the buffer
+        size = os.stat(file)[6]
         async with OpenFileSafely(file, 'rb') as f:
-            while 1:
-                bytes_buf = f.read(chunk_size)
-                if bytes_buf == b'':
-                    break
-                for i in range(chunk_size):
-                    self.epd.buffer_4Gray[buf_index+i] = bytes_buf[i]
-                buf_index += chunk_size
+            image_format.read_into(f, size, self.epd.buffer_4Gray)
         self.epd.image4Gray.text(marker['text'], 5, 5, self.epd.white)
 
-        # display and intentionally block
-        self.write_buffer_to_display()
-        viewing_duration = 15 # seconds
-        utime.sleep(viewing_duration)
+        # Keep the image on the display until a key is pressed or for MARKER_IMG_VIEWING_DURATION, other tasks keep
+        # running but no other e-Paper job is run meanwhile. The key press only closes the image
+        finished_flag = asyncio.ThreadSafeFlag()
+        await self.present(finished_flag)
+        await finished_flag.wait()
+        events = self.buttons.listen()
+        try:
+            await asyncio.wait_for(events.get(), MARKER_IMG_VIEWING_DURATION)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.buttons.stop_listening(events)
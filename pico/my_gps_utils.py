@@ -1,112 +1,280 @@
 import utime
+import math
 from machine import RTC, UART
 try:
     import uasyncio as asyncio
 except ImportError:
     import asyncio
 from micropyGPS import MicropyGPS
+import ubx_parser
+try:
+    import micropython
+    VIPER = True
+except ImportError:
+    VIPER = False
+
+if VIPER:
+    # index of the first byte with value c in buf[start:end], -1 if there is none
+    @micropython.viper
+    def _find_byte(buf: ptr8, start: int, end: int, c: int) -> int:
+        for i in range(start, end):
+            if buf[i] == c:
+                return i
+        return -1
+else:
+    def _find_byte(buf, start, end, c):
+        return buf.find(bytes((c,)), start, end)
+
+# Reads complete sentences from the UART as soon as they arrive, instead of polling it.
+# Received bytes go into a preallocated ring buffer and every complete NMEA sentence (ending in CRLF)
+# or UBX frame is returned as a memoryview, which is only valid until the next sentence is read.
+# Sentences that wrap around the end of the ring are copied into a preallocated line buffer.
+class UartSentenceReader:
+    def __init__(self, uart: UART, protocol='nmea', size=1024, max_sentence_len=256):
+        self.__stream = asyncio.StreamReader(uart)
+        self.__ubx = protocol == 'ubx'
+        self.__size = size
+        self.__buf = bytearray(size)
+        self.__mv = memoryview(self.__buf)
+        self.__line = bytearray(max_sentence_len)
+        self.__line_mv = memoryview(self.__line)
+        self.__head = 0 # ring index of the first unread byte
+        self.__count = 0 # number of unread bytes in the ring
+        self.__scanned = 0 # number of unread bytes already searched for a line ending
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while 1:
+            length = self.__frame_length()
+            if length > 0:
+                return self.__take(length)
+            await self.__fill()
+
+    # wait for more data from the uart and read it into the free part of the ring
+    async def __fill(self):
+        if self.__count == self.__size:
+            # ring is full of data that never formed a sentence, throw it away
+            self.__head = 0
+            self.__count = 0
+        tail = (self.__head + self.__count) % self.__size
+        free = min(self.__size - self.__count, self.__size - tail)
+        n = await self.__stream.readinto(self.__mv[tail:tail+free])
+        if n:
+            self.__count += n
+
+    # length of the complete sentence at the start of the ring, 0 if it hasn't arrived yet
+    def __frame_length(self):
+        if self.__ubx:
+            return self.__ubx_frame_length()
+        end = self.__find(0x0a, self.__scanned) # LF
+        if end == -1:
+            self.__scanned = self.__count
+            return 0
+        if end >= len(self.__line):
+            # too long to be a sentence, drop it
+            self.__advance(end+1)
+            return 0
+        return end+1
+
+    def __ubx_frame_length(self):
+        while 1:
+            start = self.__find(0xb5) # first sync char
+            if start == -1:
+                self.__advance(self.__count)
+                return 0
+            self.__advance(start)
+            if self.__count < 6:
+                return 0
+            length = self.__peek(4) | (self.__peek(5) << 8)
+            if self.__peek(1) == 0x62 and length + 8 <= len(self.__line):
+                return length+8 if self.__count >= length+8 else 0
+            # not a frame after all, skip the false sync char
+            self.__advance(1)
+
+    # index (relative to head) of the first byte with value c at or after start, -1 if not found
+    def __find(self, c, start=0):
+        first_end = min(self.__head + self.__count, self.__size)
+        if self.__head + start < first_end:
+            i = _find_byte(self.__buf, self.__head + start, first_end, c)
+            if i != -1:
+                return i - self.__head
+        wrapped = self.__head + self.__count - self.__size
+        first = max(0, self.__head + start - self.__size)
+        if first < wrapped:
+            i = _find_byte(self.__buf, first, wrapped, c)
+            if i != -1:
+                return i + self.__size - self.__head
+        return -1
+
+    def __peek(self, i):
+        return self.__buf[(self.__head + i) % self.__size]
+
+    def __advance(self, n):
+        self.__head = (self.__head + n) % self.__size
+        self.__count -= n
+        self.__scanned = max(0, self.__scanned - n)
+
+    # consume the next n bytes and return them as one contiguous memoryview
+    def __take(self, n):
+        head = self.__head
+        self.__advance(n)
+        if head + n <= self.__size:
+            return self.__mv[head:head+n]
+        first = self.__size - head
+        self.__line[:first] = self.__mv[head:]
+        self.__line[first:n] = self.__mv[:n-first]
+        return self.__line_mv[:n]
+
+# fix qualities
+FIX_NONE = 0
+FIX_2D = 2
+FIX_3D = 3
+
+# Snapshot of one fix, published by GPS and never modified afterwards
+class Fix:
+    def __init__(self, time, lat, long, pdop, sats, quality):
+        self.time = time # seconds, from the RTC
+        self.lat = lat
+        self.long = long
+        self.pdop = pdop
+        self.sats = sats # satellites visible
+        self.quality = quality # FIX_2D or FIX_3D
+        self.ticks = utime.ticks_ms()
+
+    # milliseconds since the fix was published
+    def age(self):
+        return utime.ticks_diff(utime.ticks_ms(), self.ticks)
+
+    def latlong(self):
+        return [self.lat, self.long]
 
 ###########################################################
 # DO NOT USE GPS METHODS BEFORE CALLING .initialize() FIRST
 ###########################################################
 
 class GPS:
-    def __init__(self, uart: UART, debug=False):
+    # protocol is 'nmea' (text sentences, parsed by MicropyGPS) or 'ubx' (binary NAV-PVT messages, parsed by
+    # UbxParser, needs a u-blox receiver). rate_ms is the fix interval to configure when using ubx
+    def __init__(self, uart: UART, debug=False, protocol='nmea', rate_ms=1000):
         self.uart = uart
-        self.reader = MicropyGPS()
+        self.protocol = protocol
+        self.rate_ms = rate_ms if protocol == 'ubx' else 1000
+        if protocol == 'ubx':
+            self.reader = ubx_parser.UbxParser()
+            self._configure_ubx()
+        else:
+            self.reader = MicropyGPS()
+            # only parse the sentences needed for position, pdop and satellite count
+            self.reader.set_interest(('RMC', 'GGA', 'GSA', 'GSV'))
+        self.sentences = UartSentenceReader(uart, protocol)
+        # sentence that completes a fix
+        self._fix_sentence = 'NAV-PVT' if protocol == 'ubx' else 'RMC'
         self.__gotInitialFix = False
+        self.__producer = None
+        self.__fix_event = asyncio.Event()
+        self.fix = None # latest Fix
         self.debug = debug
         self.rtc = RTC()
         # other
         self.timezone_diff = 4 # only used for self.timeFormatted()
         self.distBetweenLatitudes = 111190 # NOTE constant for anywhere in the world
-        self.distBetweenLongitudes = 85050 # NOTE depends on which latitude you measure at. This is an approximation for latitude 40.1 N
+        self.distBetweenLongitudes = None # NOTE depends on the latitude, see setReferenceLatitude()
+        self.referenceLatitude = None
+        self.setReferenceLatitude(40) # until the map data is known
+
+    # switch the receiver's output from NMEA to NAV-PVT at the configured rate, plus NAV-SAT for debugging info
+    def _configure_ubx(self):
+        for msg in ubx_parser.cfg_disable_nmea():
+            self.uart.write(msg)
+        self.uart.write(ubx_parser.cfg_enable_nav_pvt())
+        self.uart.write(ubx_parser.cfg_enable_nav_sat())
+        self.uart.write(ubx_parser.cfg_rate(self.rate_ms))
 
-    # get serial data from UART
-    async def _read_UART(self):
+    # Fix producer: the only reader of the UART. Parses sentences as they arrive and publishes
+    # a new Fix snapshot every time a fix is complete (its RMC sentence, or NAV-PVT message when
+    # using ubx, has been parsed)
+    async def _produce_fixes(self):
         while 1:
-            # wait until there's data available to read from uart
-            if self.uart.any() == 0:
-                if self.debug:
-                    print('No data to read from UART')
-                await asyncio.sleep(0.1)
-                continue
-            
-            # read uart data
+            sentence = await self.sentences.__anext__()
+            if self.debug:
+                print(bytes(sentence))
             try:
-                data = self.uart.read()
-                data = data.decode('ascii')
-                data = data.strip()
-            except UnicodeError as e:
+                parsed = self.reader.update_buffer(sentence)
+            except Exception as e:
                 if self.debug:
-                    print('Unicode Error while decoding GPS buffer')
-                await asyncio.sleep(0.1)
+                    print('Error in parser update_buffer():', e)
                 continue
-            
-            # return data
-            if self.debug:
-                print(data)
-            return data
+            if not any(sentence_type.endswith(self._fix_sentence) for sentence_type in parsed):
+                continue
+
+            quality = self._fix_quality()
+            if quality == FIX_NONE:
+                if self.__gotInitialFix:
+                    print('Waiting for GPS fix...')
+                continue
+            lat, long = self.reader.latlong()
+            self.fix = Fix(self.time(), lat, long, self.reader.pdop, self.reader.satellites_in_view, quality)
+
+            # wake up everyone waiting for a new fix
+            fix_event = self.__fix_event
+            self.__fix_event = asyncio.Event()
+            fix_event.set()
+
+    def _fix_quality(self):
+        if self.reader.time_since_fix() == -1:
+            return FIX_NONE
+        lat, long = self.reader.latlong()
+        if lat == 0.0 or long == 0.0:
+            return FIX_NONE
+        # a position without a GSA/fix type yet is at least a 2D fix
+        return min(max(self.reader.fix_type, FIX_2D), FIX_3D)
 
-    # fetch new gps data and update gps.reader
-    async def update(self, count, led=None):
+    # Get the latest fix. Returns immediately if it is at most max_age_ms old and its quality is at least
+    # min_quality (FIX_2D or FIX_3D), otherwise waits for the next fix that is good enough
+    async def get_fix(self, max_age_ms=1500, min_quality=FIX_2D, led=None):
         if led is not None:
             led.on()
-            
-        while True:
-            if count == 0:
-                break
-            
-            # update gps parser with data
-            data = await self._read_UART()
-            for char in data:
-                try:
-                    self.reader.update(char)
-                except Exception as e:
-                    err = f'Error in micropyGPS.update(): {e}'
-            
-            # make sure fix was not lost
-            if self.__gotInitialFix and \
-                    (self.reader.time_since_fix() == -1 or self.latlong()[0] == 0.0 or self.latlong()[1] == 0.0):
-                print('Waiting for GPS fix...')
-                count += 1
-            
-            # sleep 1s bc gps outputs at 1Hz, then continue
-            if count > 1:
-                await asyncio.sleep(1)
-            count -= 1
-        
+        fix = self.fix
+        while fix is None or fix.age() > max_age_ms or fix.quality < min_quality:
+            await self.__fix_event.wait()
+            fix = self.fix
+        if led is not None:
+            led.off()
+        return fix
+
+    # wait for count new fixes, the last of which is returned
+    async def update(self, count=1, led=None):
+        if led is not None:
+            led.on()
+        for _ in range(count):
+            await self.__fix_event.wait()
         if led is not None:
             led.off()
+        return self.fix
 
-    # get location fix
+    # start the fix producer and wait for a location fix
     async def initialize(self):
+        if self.__producer is None:
+            self.__producer = asyncio.create_task(self._produce_fixes())
         # wait for fix
         print('Waiting for GPS fix...')
-        await self.update(1)
-        while self.reader.time_since_fix() == -1:
-            await asyncio.sleep(1.1)
-            await self.update(1)
+        await self.get_fix(max_age_ms=self.rate_ms)
         self.__gotInitialFix = True
-        await self.update(3)
         # set RTC
         day, month, year, hour, minute, second = [int(x) for x in list(self.reader.date) + self.reader.timestamp]
         datetime = (year+2000, month, day, None, hour, minute, second, 0)
         self.rtc.datetime(datetime)
+        # publish a fix with the correct time
+        await self.update(1)
         print('GPS fix obtained')
 
-    # continuously track
-    async def start_continuous_tracking(self, interval=1.1):
-        while 1:
-            await self.update(1)
-            await asyncio.sleep(interval)
-
+    # latest published position
     def latlong(self):
-        lat = self.reader.latitude
-        lat = (lat[0] + lat[1]/60) * (1 if lat[2] == 'N' else -1)
-        long = self.reader.longitude
-        long = (long[0] + long[1]/60) * (1 if long[2] == 'E' else -1)
-        return [lat, long]
+        if self.fix is None:
+            return list(self.reader.latlong())
+        return [self.fix.lat, self.fix.long]
             
     # get debugging info
     def getDebugInfo(self):
@@ -136,6 +304,16 @@ class GPS:
         timeString = f'{month}/{day}/{year}, {(hour-self.timezone_diff)%12}:{minute}:{second}'
         return timeString
 
+    # Longitudes are converted to meters at a reference latitude: the middle of the map data, rounded to whole degrees
+    # so it rarely changes and utils/build_tiles.py comes to the same value. Returns True if it changed
+    def setReferenceLatitude(self, lat):
+        lat = round(lat)
+        if lat == self.referenceLatitude:
+            return False
+        self.referenceLatitude = lat
+        self.distBetweenLongitudes = round(self.distBetweenLatitudes * math.cos(lat * math.pi / 180))
+        return True
+
     def latToMeters(self, lat):
         return lat * self.distBetweenLatitudes
 
@@ -74,12 +74,13 @@ def redirect(uri):
 
 class Request:
     def __init__(self, buf) -> None:
+        # keep the raw body, binary uploads can happen to be valid UTF-8
+        requestParts = buf.split(b'\r\n\r\n', 1)
+        self.file = b'' if len(requestParts) == 1 else requestParts[1]
         try:
             request = buf.decode()
         except UnicodeError:
             print('UnicodeError while decoding request: assuming request body contains a file')
-            requestParts = buf.split(b'\r\n\r\n', 1)
-            self.file = requestParts[1]
             request = requestParts[0].decode()
         request = normalize_line_endings(request)
         requestParts = request.split('\n\n', 1)
@@ -88,10 +89,11 @@ class Request:
 
         request_head = request_head.splitlines()
         request_headline = request_head[0]
-        if len(request_head) == 1:
-            self.headers = dict()
-        else:
-            self.headers = dict(x.split(': ', 1) for x in request_head[1:])
+        # header names are case-insensitive, so they're stored lower case
+        self.headers = dict()
+        for line in request_head[1:]:
+            name, value = line.split(': ', 1)
+            self.headers[name.lower()] = value
         self.method, self.route, self.protocol = request_headline.split(' ', 3)
 
         routeParts = self.route.split('?')
@@ -137,7 +139,8 @@ class App:
         writer.write(response_headline.encode())
         writer.write(response_headers_raw.encode())
         writer.write('\r\n\r\n'.encode()) # to separate headers from body
-        writer.write(response_body.encode())
+        # binary files are sent as is
+        writer.write(response_body if isinstance(response_body, bytes) else response_body.encode())
         await writer.drain()
 
     async def server_callback(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
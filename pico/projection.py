@@ -0,0 +1,181 @@
+from array import array
+from raster import clip_segment
+try:
+    import micropython
+    VIPER = True
+except ImportError:
+    VIPER = False
+
+# Fixed-point projection of coordinates in microdegrees to pixels, for drawing whole batches of track points without
+# a float or a function call per point:
+#   x = x0 + (long - long0) * kx >> frac_bits
+#   y = y0 - (lat - lat0) * ky >> frac_bits
+# where kx, ky are the pixels per microdegree of longitude and latitude scaled by 2 ** frac_bits (kx includes the
+# cos(latitude) factor of the GPS's distBetweenLongitudes). Only points within clamp pixels of the origin (the clamp
+# box) are projected, so all products fit into the 32 bit ints of the viper kernel and the results into int16 arrays.
+# frac_bits is as large as that allows, a smaller clamp gives more precise factors.
+# Single points outside the box are moved onto it. Polylines are clipped to it in microdegrees before they're
+# projected, so segments leaving the box keep their direction, and the parts outside it are replaced by a path along
+# its edges. The box has to contain the view with a margin, so that path is never visible.
+MAX_POINTS_OUT = 5 # points written per point of a polyline at most
+
+class Projection:
+    def __init__(self, lat0, long0, x0, y0, px_per_meter, dist_between_latitudes, dist_between_longitudes, clamp=4096):
+        self.lat0 = lat0
+        self.long0 = long0
+        self.x0 = x0
+        self.y0 = y0
+        self.frac_bits = 30 - clamp.bit_length()
+        one = 1 << self.frac_bits
+        self.kx = max(1, round(dist_between_longitudes * px_per_meter / 1e6 * one))
+        self.ky = max(1, round(dist_between_latitudes * px_per_meter / 1e6 * one))
+        self.max_dlong = clamp * one // self.kx
+        self.max_dlat = clamp * one // self.ky
+        if VIPER:
+            self.__params = array('i', [lat0, long0, x0, y0, self.kx, self.ky, self.max_dlat, self.max_dlong,
+                                        self.frac_bits])
+
+    # Project the polyline through the first n points of lats, longs (int32 arrays or memoryviews of microdegrees, or
+    # NumPy arrays on the host) into xs, ys (int16 arrays with room for MAX_POINTS_OUT * n points) from index start
+    # on. Returns the index after the last point written.
+    # prev carries the polyline over to the next call: an array('i', [0, 0, 0]) that is set to [1, lat, long] of the
+    # last point. Set prev[0] to 0 to start a new polyline, without prev every call starts one
+    def project(self, lats, longs, n, xs, ys, start=0, prev=None):
+        p = None # previous point as (dlat, dlong) from the origin
+        if prev is not None and prev[0]:
+            p = (prev[1] - self.lat0, prev[2] - self.long0)
+        k = start
+        i = 0
+        if hasattr(lats, 'dtype'):
+            if self.__project_numpy(lats, longs, n, xs, ys, start, p):
+                k = start + n
+                i = n
+            else:
+                lats = lats[:n].tolist()
+                longs = longs[:n].tolist()
+        while i < n:
+            # runs of points inside the box go through the viper kernel
+            if VIPER and (p is None or self.__inside(*p)):
+                j = _project(lats, longs, i, n, xs, ys, k, self.__params)
+                if j > i:
+                    k += j - i
+                    i = j
+                    p = (lats[i-1] - self.lat0, longs[i-1] - self.long0)
+                    if i == n:
+                        break
+            c = (lats[i] - self.lat0, longs[i] - self.long0)
+            k = self.__segment(p, c, xs, ys, k)
+            p = c
+            i += 1
+        if prev is not None and n:
+            prev[0] = 1
+            prev[1] = p[0] + self.lat0
+            prev[2] = p[1] + self.long0
+        return k
+
+    # all points inside the box are projected at once, returns False without projecting anything otherwise
+    def __project_numpy(self, lats, longs, n, xs, ys, start, p):
+        dlong = longs[:n].astype('int64') - self.long0
+        dlat = lats[:n].astype('int64') - self.lat0
+        if ((p is not None and not self.__inside(*p)) or (abs(dlong) > self.max_dlong).any()
+                or (abs(dlat) > self.max_dlat).any()):
+            return False
+        half = 1 << (self.frac_bits - 1)
+        xs[start:start+n] = self.x0 + ((dlong * self.kx + half) >> self.frac_bits)
+        ys[start:start+n] = self.y0 - ((dlat * self.ky + half) >> self.frac_bits)
+        return True
+
+    def __inside(self, dlat, dlong):
+        return -self.max_dlat <= dlat <= self.max_dlat and -self.max_dlong <= dlong <= self.max_dlong
+
+    def __clamp(self, dlat, dlong):
+        return min(self.max_dlat, max(-self.max_dlat, dlat)), min(self.max_dlong, max(-self.max_dlong, dlong))
+
+    # write the pixel of (dlat, dlong) inside the box to index k, returns the next index
+    def __emit(self, d, xs, ys, k):
+        half = 1 << (self.frac_bits - 1)
+        xs[k] = self.x0 + ((d[1] * self.kx + half) >> self.frac_bits)
+        ys[k] = self.y0 - ((d[0] * self.ky + half) >> self.frac_bits)
+        return k + 1
+
+    # Write the polyline's part from the previous point p (None for the first point) to c. The last point written is
+    # always c, or c moved onto the box if it's outside
+    def __segment(self, p, c, xs, ys, k):
+        if p is None:
+            return self.__emit(self.__clamp(*c), xs, ys, k)
+        p_inside = self.__inside(*p)
+        if p_inside and self.__inside(*c):
+            return self.__emit(c, xs, ys, k)
+        # longitude is x and latitude y
+        segment = clip_segment(p[1], p[0], c[1], c[0], -self.max_dlong, -self.max_dlat, self.max_dlong, self.max_dlat)
+        if segment is None:
+            return self.__walk(self.__clamp(*p), self.__clamp(*c), xs, ys, k)
+        a = (segment[1], segment[0])
+        b = (segment[3], segment[2])
+        if not p_inside:
+            k = self.__walk(self.__clamp(*p), a, xs, ys, k)
+        k = self.__emit(b, xs, ys, k)
+        if b != c:
+            k = self.__walk(b, self.__clamp(*c), xs, ys, k)
+        return k
+
+    # Write the path along the box's edges from u to v, both on the box, without u
+    def __walk(self, u, v, xs, ys, k):
+        max_dlat = self.max_dlat
+        max_dlong = self.max_dlong
+        u_vertical = abs(u[1]) == max_dlong
+        u_horizontal = abs(u[0]) == max_dlat
+        v_vertical = abs(v[1]) == max_dlong
+        v_horizontal = abs(v[0]) == max_dlat
+        if (u_vertical and u[1] == v[1]) or (u_horizontal and u[0] == v[0]):
+            pass # same edge
+        elif u_vertical and v_horizontal:
+            k = self.__emit((v[0], u[1]), xs, ys, k)
+        elif u_horizontal and v_vertical:
+            k = self.__emit((u[0], v[1]), xs, ys, k)
+        elif u_vertical:
+            # opposite edges, around either side will do
+            k = self.__emit((max_dlat, u[1]), xs, ys, k)
+            k = self.__emit((max_dlat, v[1]), xs, ys, k)
+        else:
+            k = self.__emit((u[0], max_dlong), xs, ys, k)
+            k = self.__emit((v[0], max_dlong), xs, ys, k)
+        return self.__emit(v, xs, ys, k)
+
+    # pixel of a point in microdegrees
+    def point_udeg(self, lat, long):
+        half = 1 << (self.frac_bits - 1)
+        dlong = min(self.max_dlong, max(-self.max_dlong, long - self.long0))
+        dlat = min(self.max_dlat, max(-self.max_dlat, lat - self.lat0))
+        return self.x0 + ((dlong * self.kx + half) >> self.frac_bits), self.y0 - ((dlat * self.ky + half) >> self.frac_bits)
+
+    # pixel of a point in degrees
+    def point(self, lat, long):
+        return self.point_udeg(round(lat * 1e6), round(long * 1e6))
+
+if VIPER:
+    # Project points from index i on into xs, ys from index k on, until the first point outside the box.
+    # Returns the index of that point, n if there is none. Loads are cast to int so the comparisons and shifts are
+    # signed
+    @micropython.viper
+    def _project(lats: ptr32, longs: ptr32, i: int, n: int, xs: ptr16, ys: ptr16, k: int, params: ptr32) -> int:
+        lat0 = int(params[0])
+        long0 = int(params[1])
+        x0 = int(params[2])
+        y0 = int(params[3])
+        kx = int(params[4])
+        ky = int(params[5])
+        max_dlat = int(params[6])
+        max_dlong = int(params[7])
+        frac_bits = int(params[8])
+        half = 1 << (frac_bits - 1)
+        while i < n:
+            dlong = int(longs[i]) - long0
+            dlat = int(lats[i]) - lat0
+            if dlong > max_dlong or dlong < 0 - max_dlong or dlat > max_dlat or dlat < 0 - max_dlat:
+                break
+            xs[k] = x0 + ((dlong * kx + half) >> frac_bits)
+            ys[k] = y0 - ((dlat * ky + half) >> frac_bits)
+            i += 1
+            k += 1
+        return i
@@ -0,0 +1,267 @@
+# Raster operations for the e-Paper's framebuffer.
+# dilate() works directly on the bytes of a GS2_HMSB framebuffer (2 bits per pixel, 4 pixels per byte, leftmost
+# pixel in the lowest bits, rows of (width + 3) // 4 bytes), instead of going through FrameBuffer.pixel().
+# Pixels are handled as masks with one flag per pixel at the low bit of the pixel's 2 bits, so neighbouring pixels
+# are a shift by 2 apart and a whole row of flags can be set to a color by multiplying the mask with the color.
+from array import array
+try:
+    import micropython
+    VIPER = True
+except ImportError:
+    VIPER = False
+
+WHITE = 0b11
+
+if VIPER:
+    # one pass of dilate() on 4 pixels at a time
+    # rowmasks is scratch space for the non-white masks of the rows above, at, and below the current row
+    @micropython.viper
+    def _dilate_pass(buf: ptr8, stride: int, rows: int, color: int, rowmasks: ptr8):
+        up = 0
+        cur = stride
+        down = 2 * stride
+        for j in range(stride):
+            rowmasks[up + j] = 0
+            b = buf[j]
+            rowmasks[cur + j] = (0xff ^ (b & (b >> 1))) & 0x55
+        for r in range(rows):
+            off = r * stride
+            # mask of the next row, taken before the current row is written
+            for j in range(stride):
+                if r + 1 < rows:
+                    b = buf[off + stride + j]
+                    rowmasks[down + j] = (0xff ^ (b & (b >> 1))) & 0x55
+                else:
+                    rowmasks[down + j] = 0
+            for j in range(stride):
+                m = rowmasks[cur + j]
+                d = m | ((m << 2) & 0xff) | (m >> 2) | rowmasks[up + j] | rowmasks[down + j]
+                if j > 0:
+                    d |= rowmasks[cur + j - 1] >> 6
+                if j < stride - 1:
+                    d |= (rowmasks[cur + j + 1] & 1) << 6
+                buf[off + j] = (buf[off + j] & (0xff ^ (d * 3))) | (d * color)
+            t = up
+            up = cur
+            cur = down
+            down = t
+
+# one pass of dilate() on whole rows as ints
+def _dilate_pass_int(buf, width, stride, rows, color):
+    flags = int.from_bytes(b'\x55' * stride, 'little') & ((1 << (2 * width)) - 1)
+    def row_mask(r):
+        if r >= rows:
+            return 0
+        v = int.from_bytes(buf[r * stride:(r+1) * stride], 'little')
+        return ~(v & (v >> 1)) & flags
+    up = 0
+    cur = row_mask(0)
+    for r in range(rows):
+        down = row_mask(r + 1)
+        d = (cur | (cur << 2) | (cur >> 2) | up | down) & flags
+        v = int.from_bytes(buf[r * stride:(r+1) * stride], 'little')
+        buf[r * stride:(r+1) * stride] = ((v & ~(d * 3)) | (d * color)).to_bytes(stride, 'little')
+        up = cur
+        cur = down
+
+# Set every pixel within radius pixels (4-connected, so a diamond) of a non-white pixel to color
+def dilate(buf, width, height, color, radius=1):
+    stride = (width + 3) // 4
+    if VIPER:
+        rowmasks = bytearray(3 * stride)
+        for _ in range(radius):
+            _dilate_pass(buf, stride, height, color, rowmasks)
+    else:
+        for _ in range(radius):
+            _dilate_pass_int(buf, width, stride, height, color)
+
+# Draw the polyline through the first n points of xs, ys (arrays of pixel coordinates) moved by (dx, dy) in color.
+# Lines are radius pixels thick on each side with round joins, so a line with radius r looks like a 1 pixel
+# line dilated r times. Each segment is filled as a quad with a disc on every point.
+# clip is an optional (xmin, ymin, xmax, ymax) rectangle segments are clipped to, segments outside it are skipped.
+# It should leave a margin of more than radius around the framebuffer, so the discs at clipped ends aren't visible
+def polyline(fb, xs, ys, n, color, radius=0, dx=0, dy=0, clip=None):
+    if radius and n == 1:
+        fb.ellipse(xs[0] + dx, ys[0] + dy, radius, radius, color, True)
+        return
+    quad = array('i', [0] * 8) if radius else None
+    # end of the last segment drawn, which already has its disc
+    lastX = None
+    lastY = None
+    for i in range(1, n):
+        x0 = xs[i-1] + dx
+        y0 = ys[i-1] + dy
+        x1 = xs[i] + dx
+        y1 = ys[i] + dy
+        if clip is not None:
+            segment = clip_segment(x0, y0, x1, y1, *clip)
+            if segment is None:
+                continue
+            x0, y0, x1, y1 = segment
+        if radius == 0:
+            fb.line(x0, y0, x1, y1, color)
+            continue
+        if x0 != lastX or y0 != lastY:
+            fb.ellipse(x0, y0, radius, radius, color, True)
+        fb.ellipse(x1, y1, radius, radius, color, True)
+        lastX = x1
+        lastY = y1
+        sx = x1 - x0
+        sy = y1 - y0
+        length = (sx * sx + sy * sy) ** 0.5
+        if length == 0:
+            continue
+        # offset of the quad's sides from the segment
+        ox = round(-sy * radius / length)
+        oy = round(sx * radius / length)
+        quad[0] = x0 + ox
+        quad[1] = y0 + oy
+        quad[2] = x1 + ox
+        quad[3] = y1 + oy
+        quad[4] = x1 - ox
+        quad[5] = y1 - oy
+        quad[6] = x0 - ox
+        quad[7] = y0 - oy
+        fb.poly(0, 0, quad, color, True)
+
+if VIPER:
+    @micropython.viper
+    def _row_hashes(buf: ptr8, stride: int, rows: int, hashes: ptr32):
+        for r in range(rows):
+            h = (0x811c << 16) | 0x9dc5
+            for i in range(r * stride, (r+1) * stride):
+                h = (h ^ buf[i]) * 0x01000193
+            hashes[r] = h
+
+# Hash every row of the framebuffer into hashes, an array('I') with an entry per row (FNV-1a, or the builtin hash
+# without viper), so frames can be compared without keeping a copy of them
+def row_hashes(buf, width, height, hashes):
+    stride = (width + 3) // 4
+    if VIPER:
+        _row_hashes(buf, stride, height, hashes)
+    else:
+        for r in range(height):
+            hashes[r] = hash(bytes(buf[r * stride:(r+1) * stride])) & 0xffffffff
+
+if VIPER:
+    @micropython.viper
+    def _has_gray(buf: ptr8, stride: int, x0: int, y0: int, x1: int, y1: int) -> int:
+        for r in range(y0, y1):
+            for i in range(r * stride + x0, r * stride + x1):
+                b = buf[i]
+                if (b ^ (b >> 1)) & 0x55:
+                    return 1
+        return 0
+
+# Whether any pixel in the rectangle (x, y, w, h) of the framebuffer is gray, i.e. its two bits differ (black is 0b00,
+# white 0b11). x and w are widened to multiples of 8 like the windows of partial refreshes
+def has_gray(buf, width, height, x, y, w, h):
+    stride = (width + 3) // 4
+    x0 = (max(0, x) & ~7) // 4
+    x1 = min(stride, ((x + w + 7) & ~7) // 4)
+    y0 = max(0, y)
+    y1 = min(height, y + h)
+    if x0 >= x1 or y0 >= y1:
+        return False
+    if VIPER:
+        return bool(_has_gray(buf, stride, x0, y0, x1, y1))
+    for r in range(y0, y1):
+        for b in buf[r * stride + x0:r * stride + x1]:
+            if (b ^ (b >> 1)) & 0x55:
+                return True
+    return False
+
+# Simplify the polyline through the first n points of xs, ys with Douglas-Peucker: points less than tolerance pixels
+# from the simplified line are dropped. The kept points are moved to the front of xs, ys and their number returned.
+# Iterative with a stack of (first, last) spans, distances are compared squared and scaled by the span's length
+# squared so everything stays in ints
+def simplify(xs, ys, n, tolerance=1):
+    if n < 3:
+        return n
+    keep = bytearray(n)
+    keep[0] = 1
+    keep[n-1] = 1
+    stack = [(0, n-1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        x0 = xs[first]
+        y0 = ys[first]
+        dx = xs[last] - x0
+        dy = ys[last] - y0
+        length2 = dx * dx + dy * dy
+        limit = tolerance * tolerance * max(1, length2)
+        worst = limit
+        index = -1
+        for i in range(first + 1, last):
+            px = xs[i] - x0
+            py = ys[i] - y0
+            t = px * dx + py * dy
+            if length2 == 0 or t <= 0:
+                d = (px * px + py * py) * max(1, length2)
+            elif t >= length2:
+                qx = px - dx
+                qy = py - dy
+                d = (qx * qx + qy * qy) * length2
+            else:
+                cross = px * dy - py * dx
+                d = cross * cross
+            if d > worst:
+                worst = d
+                index = i
+        if index >= 0:
+            keep[index] = 1
+            stack.append((first, index))
+            stack.append((index, last))
+    m = 0
+    for i in range(n):
+        if keep[i]:
+            xs[m] = xs[i]
+            ys[m] = ys[i]
+            m += 1
+    return m
+
+def _outcode(x, y, xmin, ymin, xmax, ymax):
+    code = 0
+    if x < xmin:
+        code |= 1
+    elif x > xmax:
+        code |= 2
+    if y < ymin:
+        code |= 4
+    elif y > ymax:
+        code |= 8
+    return code
+
+# Clip the segment from (x0, y0) to (x1, y1) to the rectangle [xmin, xmax] x [ymin, ymax] (Cohen-Sutherland).
+# Returns the clipped (x0, y0, x1, y1), or None if the segment is entirely outside
+def clip_segment(x0, y0, x1, y1, xmin, ymin, xmax, ymax):
+    code0 = _outcode(x0, y0, xmin, ymin, xmax, ymax)
+    code1 = _outcode(x1, y1, xmin, ymin, xmax, ymax)
+    while 1:
+        if not (code0 | code1):
+            return x0, y0, x1, y1
+        if code0 & code1:
+            return None
+        code = code0 or code1
+        if code & 8:
+            x = x0 + (x1 - x0) * (ymax - y0) // (y1 - y0)
+            y = ymax
+        elif code & 4:
+            x = x0 + (x1 - x0) * (ymin - y0) // (y1 - y0)
+            y = ymin
+        elif code & 2:
+            y = y0 + (y1 - y0) * (xmax - x0) // (x1 - x0)
+            x = xmax
+        else:
+            y = y0 + (y1 - y0) * (xmin - x0) // (x1 - x0)
+            x = xmin
+        if code == code0:
+            x0 = x
+            y0 = y
+            code0 = _outcode(x0, y0, xmin, ymin, xmax, ymax)
+        else:
+            x1 = x
+            y1 = y
+            code1 = _outcode(x1, y1, xmin, ymin, xmax, ymax)
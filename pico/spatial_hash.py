@@ -0,0 +1,115 @@
+from math import floor
+
+# Grid-hashed spatial index for points stored as dicts with 'lat' and 'long' keys (junctions, markers).
+# Points are bucketed into square cells of cell_size meters, so lookups around a position only look at the
+# points in nearby cells instead of the whole list. The index must be kept in sync with the list it indexes
+# through add() and remove().
+class SpatialHash:
+    def __init__(self, dist_between_latitudes, dist_between_longitudes, cell_size=50, items=()):
+        self.__lat_scale = dist_between_latitudes / cell_size # cells per degree
+        self.__long_scale = dist_between_longitudes / cell_size
+        self.__dist_between_latitudes = dist_between_latitudes
+        self.__dist_between_longitudes = dist_between_longitudes
+        self.__cell_size = cell_size
+        self.__cells = {}
+        self.__count = 0
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return self.__count
+
+    def __cell(self, lat, long):
+        return floor(lat * self.__lat_scale), floor(long * self.__long_scale)
+
+    def add(self, item):
+        key = self.__cell(item['lat'], item['long'])
+        cell = self.__cells.get(key)
+        if cell is None:
+            self.__cells[key] = [item]
+        else:
+            cell.append(item)
+        self.__count += 1
+
+    def remove(self, item):
+        key = self.__cell(item['lat'], item['long'])
+        cell = self.__cells.get(key)
+        if cell is None or item not in cell:
+            return False
+        cell.remove(item)
+        if len(cell) == 0:
+            self.__cells.pop(key)
+        self.__count -= 1
+        return True
+
+    # distance in meters
+    def dist(self, latlong1, latlong2):
+        y = (latlong1[0] - latlong2[0]) * self.__dist_between_latitudes
+        x = (latlong1[1] - latlong2[1]) * self.__dist_between_longitudes
+        return (x ** 2 + y ** 2) ** 0.5
+
+    # items in the square ring of cells at distance ring (in cells) around the cell (cy, cx)
+    def __ring(self, cy, cx, ring):
+        if ring == 0:
+            cell = self.__cells.get((cy, cx))
+            if cell is not None:
+                yield from cell
+            return
+        for y in range(cy-ring, cy+ring+1):
+            step = 1 if y in (cy-ring, cy+ring) else 2*ring
+            for x in range(cx-ring, cx+ring+1, step):
+                cell = self.__cells.get((y, x))
+                if cell is not None:
+                    yield from cell
+
+    # nearest item within radius meters of latlong, as (item, distance). (None, None) if there is none
+    def nearest(self, latlong, radius):
+        cy, cx = self.__cell(*latlong)
+        nearest = None
+        nearest_dist = radius
+        for ring in range(int(radius // self.__cell_size) + 2):
+            for item in self.__ring(cy, cx, ring):
+                dist = self.dist(latlong, (item['lat'], item['long']))
+                if dist < nearest_dist:
+                    nearest = item
+                    nearest_dist = dist
+        if nearest is None:
+            return None, None
+        return nearest, nearest_dist
+
+    # The k nearest items to latlong, sorted by distance, as a list of (item, distance).
+    # Rings of cells are only searched while they have fewer cells than there are items, after that (e.g. for a
+    # position far away from all items) every item is looked at instead
+    def k_nearest(self, latlong, k):
+        cy, cx = self.__cell(*latlong)
+        found = []
+        ring = 0
+        while (2*ring + 1) ** 2 <= self.__count:
+            for item in self.__ring(cy, cx, ring):
+                found.append((item, self.dist(latlong, (item['lat'], item['long']))))
+            # every item closer than ring cells has been seen, so the k nearest are known once there are
+            # k items within that distance
+            bound = ring * self.__cell_size
+            if len(found) >= k and sum(1 for _, dist in found if dist <= bound) >= k:
+                break
+            ring += 1
+        else:
+            found = [(item, self.dist(latlong, (item['lat'], item['long'])))
+                     for cell in self.__cells.values() for item in cell]
+        found.sort(key=lambda x: x[1])
+        return found[:k]
+
+    # items inside the bounding box [top, bottom, left, right] in degrees
+    def in_bbox(self, top, bottom, left, right):
+        y0, x0 = self.__cell(bottom, left)
+        y1, x1 = self.__cell(top, right)
+        items = []
+        for y in range(y0, y1+1):
+            for x in range(x0, x1+1):
+                cell = self.__cells.get((y, x))
+                if cell is None:
+                    continue
+                for item in cell:
+                    if bottom <= item['lat'] <= top and left <= item['long'] <= right:
+                        items.append(item)
+        return items
@@ -0,0 +1,77 @@
+import struct
+
+# Binary track format
+# A track file is an 8 byte header followed by fixed size 14 byte records, one per point:
+#   header: magic 'TMCT', format version (u8), record size (u8), 2 reserved bytes
+#   record: time in seconds (u32), latitude and longitude in microdegrees (i32 each),
+#           satellites visible (upper 6 bits) and pdop * 10 (lower 10 bits) packed into a u16
+# All values are little endian. This module only uses struct, so it also runs on a host for the utils scripts
+
+MAGIC = b'TMCT'
+VERSION = 1
+HEADER_FORMAT = '<4sBBH'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = '<IiiH'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+EXTENSION = '.trk'
+CSV_HEADER = 'time,latitude,longitude,satellites visible,pdop\n'
+
+def is_binary(filename):
+    return filename.endswith(EXTENSION)
+
+def header():
+    return struct.pack(HEADER_FORMAT, MAGIC, VERSION, RECORD_SIZE, 0)
+
+def check_header(buf):
+    magic, version, record_size, _ = struct.unpack_from(HEADER_FORMAT, buf, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+        raise ValueError('Not a binary track file')
+
+def pack_record(buf, offset, time, lat, long, sats, pdop):
+    sats_pdop = (min(int(sats), 63) << 10) | min(int(round(pdop * 10)), 1023)
+    struct.pack_into(RECORD_FORMAT, buf, offset, int(time), int(round(lat * 1e6)), int(round(long * 1e6)), sats_pdop)
+
+# returns time, latitude and longitude in microdegrees, satellites visible, pdop
+def unpack_record(buf, offset):
+    time, lat, long, sats_pdop = struct.unpack_from(RECORD_FORMAT, buf, offset)
+    return time, lat, long, sats_pdop >> 10, (sats_pdop & 1023) / 10
+
+# Iterate over all points of a binary track file as (time, latitude, longitude, satellites visible, pdop),
+# reading records_per_read records at a time into one reused buffer
+def read_points(path, records_per_read=64):
+    buf = bytearray(RECORD_SIZE * records_per_read)
+    with open(path, 'rb') as f:
+        check_header(f.read(HEADER_SIZE))
+        while 1:
+            n = f.readinto(buf) // RECORD_SIZE
+            if n == 0:
+                break
+            for i in range(n):
+                time, lat, long, sats, pdop = unpack_record(buf, i * RECORD_SIZE)
+                yield time, lat / 1e6, long / 1e6, sats, pdop
+
+### Converters between the CSV and binary track formats ###
+
+def csv_to_binary(src, dst):
+    record = bytearray(RECORD_SIZE)
+    with open(src) as f_in, open(dst, 'wb') as f_out:
+        cols = f_in.readline().strip().split(',')
+        time_col = cols.index('time')
+        lat_col = cols.index('latitude')
+        long_col = cols.index('longitude')
+        sats_col = cols.index('satellites visible')
+        pdop_col = cols.index('pdop')
+        f_out.write(header())
+        for line in f_in:
+            if line.strip() == '':
+                break
+            parts = line.split(',')
+            pack_record(record, 0, int(parts[time_col]), float(parts[lat_col]), float(parts[long_col]),
+                        int(parts[sats_col]), float(parts[pdop_col]))
+            f_out.write(record)
+
+def binary_to_csv(src, dst):
+    with open(dst, 'w') as f_out:
+        f_out.write(CSV_HEADER)
+        for time, lat, long, sats, pdop in read_points(src):
+            f_out.write(f'{time},{lat},{long},{sats},{pdop}\n')
@@ -0,0 +1,225 @@
+import os
+import json
+import track_format
+from file_utils import OpenFileSafely, TrackStream, file_exists, track_lock
+
+TRACK_INDEX_FILE = 'track_index.json'
+TRACK_TILES_DIR = 'track_tiles'
+TILE_SIZE = 2000 # microdegrees, around 220m of latitude
+
+# Metadata for every track, persisted next to tracks.json so the map bounds can be computed without reading
+# any track points. Entries look like:
+#   {'bbox': [top, bottom, left, right], 'count': 123, 'first': 1680813609, 'last': 1680814000,
+#    'size': 1730, 'version': 124, 'tiles': {'20061,-37827': [[0, 57], [101, 123]], ...}}
+# bbox is in microdegrees, first and last are timestamps (None for CSV tracks, which are indexed without them),
+# size is the size of the track file in bytes and version changes every time the track's content changes.
+# tiles is a spatial index of binary tracks (None for CSV tracks): the track's points are grouped into a grid of
+# TILE_SIZE tiles, keyed by 'lat // TILE_SIZE,long // TILE_SIZE', and each tile holds the [start, end) record
+# ranges of the points inside it, so only the part of a track inside a viewport has to be read.
+# The tiles grow with the track, so they aren't saved in TRACK_INDEX_FILE but in a file per track in TRACK_TILES_DIR
+# ({'count': 123, 'tiles': {...}}), which is only written when that track changed. Tiles that don't match the
+# entry's count are ignored and the track is indexed again.
+class TrackIndex:
+    def __init__(self):
+        self.tracks = {}
+        self.changes = 0 # incremented whenever any track changes
+        self.__unsaved_tiles = set() # tracks whose tiles changed since they were saved
+
+    async def load(self):
+        if TRACK_TILES_DIR not in os.listdir():
+            os.mkdir(TRACK_TILES_DIR)
+        if await file_exists(TRACK_INDEX_FILE):
+            async with OpenFileSafely(TRACK_INDEX_FILE, 'r') as f:
+                self.tracks = json.load(f)
+        for track, entry in self.tracks.items():
+            if 'tiles' in entry:
+                continue
+            path = tiles_path(track)
+            if await file_exists(path):
+                async with OpenFileSafely(path, 'r') as f:
+                    saved = json.load(f)
+                if saved['count'] == entry['count']:
+                    entry['tiles'] = saved['tiles']
+
+    async def save(self):
+        for track in self.__unsaved_tiles:
+            entry = self.tracks.get(track)
+            if entry is not None and entry['tiles'] is not None:
+                async with OpenFileSafely(tiles_path(track), 'w') as f:
+                    json.dump({'count': entry['count'], 'tiles': entry['tiles']}, f)
+        self.__unsaved_tiles = set()
+        # tiles of binary tracks are in their own files, CSV tracks keep 'tiles': None
+        tracks = {}
+        for track, entry in self.tracks.items():
+            if entry['tiles'] is None:
+                tracks[track] = entry
+            else:
+                tracks[track] = {key: value for key, value in entry.items() if key != 'tiles'}
+        async with OpenFileSafely(TRACK_INDEX_FILE, 'w') as f:
+            json.dump(tracks, f)
+
+    # Drop entries of deleted tracks and rebuild entries that are missing or out of date,
+    # e.g. for tracks recorded before the index existed or uploaded from elsewhere
+    async def sync(self, tracks):
+        changed = False
+        for track in list(self.tracks.keys()):
+            if track not in tracks:
+                self.remove(track)
+                changed = True
+        for track in tracks:
+            entry = self.tracks.get(track)
+            if entry is None or entry['size'] != file_size(f'tracks/{track}') or 'tiles' not in entry:
+                await self.rebuild(track)
+                changed = True
+        if changed:
+            await self.save()
+
+    # drop the entry of a deleted track
+    def remove(self, track):
+        if self.tracks.pop(track, None) is not None:
+            self.changes += 1
+        self.__unsaved_tiles.discard(track)
+        try:
+            os.remove(tiles_path(track))
+        except OSError:
+            pass
+
+    # recompute a track's entry by reading all of its points
+    async def rebuild(self, track):
+        print('Indexing track', track)
+        old_version = self.tracks[track]['version'] if track in self.tracks else 0
+        entry = self.new_entry(track)
+        entry['version'] = old_version
+        if not track_format.is_binary(track):
+            entry['tiles'] = None
+        async with TrackStream(track) as stream:
+            async for lats, longs, n in stream:
+                for i in range(n):
+                    self.__extend(entry, lats[i], longs[i])
+        if track_format.is_binary(track) and entry['count']:
+            async with track_lock(track):
+                entry['first'], entry['last'] = read_time_range(f'tracks/{track}')
+        entry['size'] = file_size(f'tracks/{track}')
+        entry['version'] += 1
+        self.changes += 1
+        self.__unsaved_tiles.add(track)
+
+    def new_entry(self, track):
+        entry = {'bbox': None, 'count': 0, 'first': None, 'last': None, 'size': 0, 'version': 0, 'tiles': {}}
+        self.tracks[track] = entry
+        return entry
+
+    # update a track's entry with a newly recorded point (coordinates in degrees)
+    def add_point(self, track, time, lat, long):
+        entry = self.tracks.get(track)
+        if entry is None:
+            entry = self.new_entry(track)
+        self.__extend(entry, int(round(lat * 1e6)), int(round(long * 1e6)))
+        if entry['first'] is None:
+            entry['first'] = time
+        entry['last'] = time
+        entry['version'] += 1
+        self.changes += 1
+        self.__unsaved_tiles.add(track)
+
+    # called once the track file has been written to
+    def set_size(self, track, size):
+        self.tracks[track]['size'] = size
+
+    def __extend(self, entry, lat, long):
+        bbox = entry['bbox']
+        if bbox is None:
+            entry['bbox'] = [lat, lat, long, long]
+        else:
+            if lat > bbox[0]:
+                bbox[0] = lat
+            elif lat < bbox[1]:
+                bbox[1] = lat
+            if long < bbox[2]:
+                bbox[2] = long
+            elif long > bbox[3]:
+                bbox[3] = long
+        # add the point's record to its tile, extending the tile's last range if possible
+        tiles = entry['tiles']
+        if tiles is not None:
+            record = entry['count']
+            key = f'{lat // TILE_SIZE},{long // TILE_SIZE}'
+            ranges = tiles.get(key)
+            if ranges is None:
+                tiles[key] = [[record, record+1]]
+            elif ranges[-1][1] == record:
+                ranges[-1][1] = record+1
+            else:
+                ranges.append([record, record+1])
+        entry['count'] += 1
+
+    # merged bounding box of all tracks as [top, bottom, left, right] in microdegrees, None if there are no points
+    def bounds(self):
+        merged = None
+        for entry in self.tracks.values():
+            bbox = entry['bbox']
+            if bbox is None:
+                continue
+            if merged is None:
+                merged = list(bbox)
+                continue
+            merged[0] = max(merged[0], bbox[0])
+            merged[1] = min(merged[1], bbox[1])
+            merged[2] = min(merged[2], bbox[2])
+            merged[3] = max(merged[3], bbox[3])
+        return merged
+
+    # Sorted, merged [start, end) record ranges of a track's points inside bbox = [top, bottom, left, right]
+    # (microdegrees). Ranges are extended by one record on each side so segments leaving the bbox are included.
+    # Returns None if the track has no spatial index and has to be read completely.
+    def ranges(self, track, bbox):
+        entry = self.tracks.get(track)
+        if entry is None or entry['tiles'] is None:
+            return None
+        top, bottom, left, right = bbox
+        found = []
+        tiles = entry['tiles']
+        for ty in range(bottom // TILE_SIZE, top // TILE_SIZE + 1):
+            for tx in range(left // TILE_SIZE, right // TILE_SIZE + 1):
+                ranges = tiles.get(f'{ty},{tx}')
+                if ranges is not None:
+                    found.extend(ranges)
+        found.sort()
+        merged = []
+        for start, end in found:
+            start = max(0, start-1)
+            end = min(entry['count'], end+1)
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    def version(self, track):
+        entry = self.tracks.get(track)
+        return 0 if entry is None else entry['version']
+
+    def count(self, track):
+        entry = self.tracks.get(track)
+        return 0 if entry is None else entry['count']
+
+# timestamps of the first and last record of a binary track
+def read_time_range(path):
+    record = bytearray(track_format.RECORD_SIZE)
+    with open(path, 'rb') as f:
+        f.seek(track_format.HEADER_SIZE)
+        f.readinto(record)
+        first = track_format.unpack_record(record, 0)[0]
+        f.seek(-track_format.RECORD_SIZE, 2)
+        f.readinto(record)
+        last = track_format.unpack_record(record, 0)[0]
+    return first, last
+
+def tiles_path(track):
+    return f'{TRACK_TILES_DIR}/{track}.json'
+
+def file_size(path):
+    try:
+        return os.stat(path)[6]
+    except OSError:
+        return -1
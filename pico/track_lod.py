@@ -0,0 +1,83 @@
+from array import array
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+from file_utils import TrackStream
+from projection import MAX_POINTS_OUT
+import raster
+
+MAX_POINTS = 8000 # of all cached tracks together, 4 bytes per point
+BATCH_SIZE = 128
+
+# Level of detail cache: simplified versions of whole tracks in map pixels, one per track and projection (zoom level),
+# so the map can be drawn from memory instead of reading every track file again.
+# Tracks are projected with a Projection and simplified with Douglas-Peucker at a tolerance of one pixel, a batch at
+# a time so the whole track never has to be in memory. Entries are kept until the track's version in the track index
+# changes. Tracks that don't fit into max_points, even after dropping the entries of other projections, are cached as
+# None and have to be streamed.
+class TrackLOD:
+    def __init__(self, max_points=MAX_POINTS):
+        self.max_points = max_points
+        self.__entries = {} # (track, projection key) -> (track version, xs, ys), xs and ys are None if too large
+        self.__num_points = 0
+
+    # Simplified track as (xs, ys) int16 arrays of pixel coordinates, or None if it's too large to cache.
+    # key identifies the projection, e.g. the zoom level
+    async def get(self, track, key, version, projection):
+        entry = self.__entries.get((track, key))
+        if entry is not None and entry[0] == version:
+            return None if entry[1] is None else (entry[1], entry[2])
+        self.__remove((track, key))
+        xs, ys = await self.__build(track, key, projection)
+        self.__entries[(track, key)] = (version, xs, ys)
+        return None if xs is None else (xs, ys)
+
+    # drop the entries of tracks that aren't in tracks anymore
+    def prune(self, tracks):
+        for entry_key in [k for k in self.__entries if k[0] not in tracks]:
+            self.__remove(entry_key)
+
+    def __remove(self, entry_key):
+        entry = self.__entries.pop(entry_key, None)
+        if entry is not None and entry[1] is not None:
+            self.__num_points -= len(entry[1])
+
+    # make room for n more points, dropping entries of other projections if necessary
+    def __reserve(self, n, key):
+        if self.__num_points + n > self.max_points:
+            for entry_key in [k for k in self.__entries if k[1] != key]:
+                self.__remove(entry_key)
+        if self.__num_points + n > self.max_points:
+            return False
+        self.__num_points += n
+        return True
+
+    async def __build(self, track, key, projection):
+        xs = array('h')
+        ys = array('h')
+        bx = array('h', [0] * (MAX_POINTS_OUT * BATCH_SIZE + 1))
+        by = array('h', [0] * (MAX_POINTS_OUT * BATCH_SIZE + 1))
+        prev = array('i', [0, 0, 0])
+        n = 0
+        async with TrackStream(track, batch_size=BATCH_SIZE) as stream:
+            async for lats, longs, count in stream:
+                n = raster.simplify(bx, by, projection.project(lats, longs, count, bx, by, n, prev))
+                # all but the last point are final, the last one starts the next batch
+                if n > 1:
+                    if not self.__reserve(n - 1, key):
+                        self.__num_points -= len(xs)
+                        return None, None
+                    xs.extend(bx[:n-1])
+                    ys.extend(by[:n-1])
+                    bx[0] = bx[n-1]
+                    by[0] = by[n-1]
+                    n = 1
+                await asyncio.sleep(0)
+        if n:
+            if not self.__reserve(1, key):
+                self.__num_points -= len(xs)
+                return None, None
+            xs.append(bx[0])
+            ys.append(by[0])
+        return xs, ys
@@ -0,0 +1,210 @@
+import struct
+from math import floor
+# millisecond ticks for fix time handling, from time on a host so the parser also runs there
+try:
+    from utime import ticks_ms, ticks_diff
+except ImportError:
+    from time import time
+    def ticks_ms():
+        return int(time() * 1000)
+    def ticks_diff(end, start):
+        return end - start
+
+# u-blox UBX binary protocol parser
+# Decodes the NAV-PVT message, which holds everything GPS needs from one fix (time, position, dop, number of
+# satellites used), and the NAV-SAT message for the ids of the satellites in view. Exposes the same query surface as
+# MicropyGPS
+
+SYNC = b'\xb5\x62'
+NAV_PVT = (0x01, 0x07)
+NAV_PVT_LEN = 92
+NAV_SAT = (0x01, 0x35)
+NAV_SAT_HEADER_LEN = 8
+NAV_SAT_BLOCK_LEN = 12 # per satellite
+NAV_SAT_RATE = 5 # navigation solutions per NAV-SAT message, it's only used for debugging info
+MAX_SATELLITES = 64
+# frame = 2 sync bytes + class + id + 2 length bytes + payload + 2 checksum bytes
+FRAME_OVERHEAD = 8
+# longer frames are skipped without being buffered
+MAX_FRAME_LEN = FRAME_OVERHEAD + NAV_SAT_HEADER_LEN + NAV_SAT_BLOCK_LEN * MAX_SATELLITES
+
+# NAV-PVT fix types
+NO_FIX = 0
+FIX_2D = 2
+FIX_3D = 3
+FIX_GNSS_DR = 4
+
+# Fletcher-8 checksum over class, id, length and payload
+def checksum(buf, start, end):
+    ck_a = 0
+    ck_b = 0
+    for i in range(start, end):
+        ck_a = (ck_a + buf[i]) & 0xff
+        ck_b = (ck_b + ck_a) & 0xff
+    return ck_a, ck_b
+
+# build a UBX frame, e.g. to configure the receiver
+def message(msg_class, msg_id, payload=b''):
+    frame = bytearray(len(payload) + FRAME_OVERHEAD)
+    frame[0:2] = SYNC
+    struct.pack_into('<BBH', frame, 2, msg_class, msg_id, len(payload))
+    frame[6:6+len(payload)] = payload
+    frame[-2], frame[-1] = checksum(frame, 2, len(frame)-2)
+    return frame
+
+# CFG-MSG: output NAV-PVT once per navigation solution on the current port
+def cfg_enable_nav_pvt():
+    return message(0x06, 0x01, bytes((NAV_PVT[0], NAV_PVT[1], 1)))
+
+# CFG-MSG: output NAV-SAT once every NAV_SAT_RATE navigation solutions on the current port
+def cfg_enable_nav_sat():
+    return message(0x06, 0x01, bytes((NAV_SAT[0], NAV_SAT[1], NAV_SAT_RATE)))
+
+# CFG-MSG: stop the default NMEA sentences (GGA, GLL, GSA, GSV, RMC, VTG) on the current port
+def cfg_disable_nmea():
+    return [message(0x06, 0x01, bytes((0xf0, nmea_id, 0))) for nmea_id in range(6)]
+
+# CFG-RATE: navigation solution every rate_ms milliseconds, aligned to GPS time
+def cfg_rate(rate_ms):
+    return message(0x06, 0x08, struct.pack('<HHH', rate_ms, 1, 1))
+
+class UbxParser:
+    def __init__(self):
+        self.buffer_tail = b''
+        # statistics, named like MicropyGPS's so debugging info stays the same
+        self.clean_sentences = 0
+        self.parsed_sentences = 0
+        self.crc_fails = 0
+        self.fix_time = 0
+        # data from NAV-PVT
+        self.timestamp = [0, 0, 0.0]
+        self.date = (0, 0, 0)
+        self.lat = 0.0
+        self.long = 0.0
+        self.altitude = 0.0
+        self.speed = [0.0, 0.0, 0.0] # knots, mph, km/h
+        self.course = 0.0
+        self.pdop = 0.0
+        self.fix_type = NO_FIX
+        self.satellites_in_use = 0
+        self.satellites_in_view = 0
+        self.valid = False
+        # data from NAV-SAT
+        self.satellite_ids = []
+        self.nav_sat_received = False
+
+    # Parse every complete UBX frame in buf (bytes, bytearray or memoryview).
+    # An incomplete frame at the end is kept and completed by the next call.
+    # Returns a list of the messages that were parsed
+    def update_buffer(self, buf):
+        parsed = []
+        if self.buffer_tail:
+            buf = self.buffer_tail + buf
+            self.buffer_tail = b''
+        elif not isinstance(buf, bytes):
+            buf = bytes(buf)
+        mv = memoryview(buf)
+        end = len(buf)
+        start = buf.find(SYNC)
+        while start != -1:
+            # wait for the rest of the header
+            if start + 6 > end:
+                self.buffer_tail = buf[start:]
+                break
+            msg_class, msg_id, length = struct.unpack_from('<BBH', mv, start+2)
+            frame_end = start + length + FRAME_OVERHEAD
+            if frame_end - start > MAX_FRAME_LEN:
+                start = buf.find(SYNC, start+2)
+                continue
+            # wait for the rest of the frame
+            if frame_end > end:
+                self.buffer_tail = buf[start:]
+                break
+            # validate checksum
+            if checksum(mv, start+2, frame_end-2) != (buf[frame_end-2], buf[frame_end-1]):
+                self.crc_fails += 1
+                start = buf.find(SYNC, start+2)
+                continue
+            self.clean_sentences += 1
+            if (msg_class, msg_id) == NAV_PVT and length == NAV_PVT_LEN:
+                self.nav_pvt(mv[start+6:frame_end-2])
+                self.parsed_sentences += 1
+                parsed.append('NAV-PVT')
+            elif (msg_class, msg_id) == NAV_SAT and length >= NAV_SAT_HEADER_LEN:
+                self.nav_sat(mv[start+6:frame_end-2])
+                self.parsed_sentences += 1
+                parsed.append('NAV-SAT')
+            start = buf.find(SYNC, frame_end)
+        return parsed
+
+    # decode the fixed-offset little endian fields of a NAV-PVT payload
+    def nav_pvt(self, payload):
+        year, month, day, hour, minute, second = struct.unpack_from('<HBBBBB', payload, 4)
+        nano = struct.unpack_from('<i', payload, 16)[0]
+        fix_type, flags, _, num_sv = struct.unpack_from('<BBBB', payload, 20)
+        long, lat, _, h_msl = struct.unpack_from('<iiii', payload, 24)
+        g_speed, head_mot = struct.unpack_from('<ii', payload, 60)
+        p_dop = struct.unpack_from('<H', payload, 76)[0]
+
+        self.timestamp = [hour, minute, second + nano / 1e9]
+        self.date = (day, month, year % 100)
+        self.fix_type = fix_type
+        self.satellites_in_use = num_sv
+        # receivers without NAV-SAT only report the satellites used
+        if not self.nav_sat_received:
+            self.satellites_in_view = num_sv
+        self.pdop = p_dop / 100
+
+        # clear position data if there is no valid fix, like MicropyGPS does
+        if flags & 0x01 and FIX_2D <= fix_type <= FIX_GNSS_DR:
+            self.lat = lat / 1e7
+            self.long = long / 1e7
+            self.altitude = h_msl / 1000
+            spd_knt = g_speed / 514.444 # mm/s to knots
+            self.speed = [spd_knt, spd_knt * 1.151, spd_knt * 1.852]
+            self.course = head_mot / 1e5
+            self.valid = True
+            self.new_fix_time()
+        else:
+            self.lat = 0.0
+            self.long = 0.0
+            self.speed = [0.0, 0.0, 0.0]
+            self.course = 0.0
+            self.valid = False
+
+    # the satellite ids (svId) of a NAV-SAT payload, a header followed by a block per satellite
+    def nav_sat(self, payload):
+        num_svs = min(payload[5], (len(payload) - NAV_SAT_HEADER_LEN) // NAV_SAT_BLOCK_LEN)
+        self.satellite_ids = [payload[NAV_SAT_HEADER_LEN + i * NAV_SAT_BLOCK_LEN + 1] for i in range(num_svs)]
+        self.satellites_in_view = num_svs
+        self.nav_sat_received = True
+
+    def new_fix_time(self):
+        self.fix_time = ticks_ms()
+
+    ### Query functions, same as MicropyGPS ###
+
+    def latlong(self):
+        return self.lat, self.long
+
+    # ids of the satellites in the last NAV-SAT message. Ids are only unique per GNSS, unlike MicropyGPS's PRNs
+    def satellites_visible(self):
+        return list(self.satellite_ids)
+
+    # milliseconds since the last message with a valid fix, -1 if no fix has been found
+    def time_since_fix(self):
+        if self.fix_time == 0:
+            return -1
+        return ticks_diff(ticks_ms(), self.fix_time)
+
+    def compass_direction(self):
+        directions = ('N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W',
+                      'WNW', 'NW', 'NNW')
+        return directions[floor(((self.course + 11.25) % 360) / 22.5)]
+
+    def speed_string(self, unit='kph'):
+        if unit == 'mph':
+            return str(self.speed[1]) + ' mph'
+        elif unit == 'knot':
+            return str(self.speed[0]) + ' knots'
+        return str(self.speed[2]) + ' km/h'
@@ -1,7 +1,11 @@
 import os
+import sys
 import json
 from zipfile import ZipFile
 import simplekml
+# track_format is shared with the pico
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pico'))
+import track_format
 
 DATA_DIR = 'storage/downloads'
 IMGS_DIR = 'storage/dcim/Tasker/TMC'
@@ -17,11 +21,23 @@ with open(os.path.join(DATA_DIR, 'junctions.json')) as f:
 with open(os.path.join(DATA_DIR, 'markers.json')) as f:
     markers_json = json.load(f)
 
-# parse CSV files
+# parse track files
 files = [file for file in os.listdir(DATA_DIR) if file.startswith('TMC_')]
 print(files)
 tracks = []
 for file in files:
+    # binary tracks
+    if track_format.is_binary(file):
+        track = []
+        for time, lat, long, sats, pdop in track_format.read_points(os.path.join(DATA_DIR, file)):
+            if lat == 0 or long == 0:
+                continue
+            track.append((long, lat))
+        tracks.append(track)
+        if DELETE_AFTER_READ:
+            os.remove(os.path.join(DATA_DIR, file))
+        continue
+
     # figure out which columns are which
     latCol = None
     longCol = None
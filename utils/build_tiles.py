@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import math
+from time import time
+from urllib.request import Request, urlopen
+import cv2
+import numpy as np
+# track_format is shared with the pico
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pico'))
+import track_format
+
+# Renders the downloaded tracks into a pyramid of map tiles, one set per zoom level, which the pico blits instead of
+# drawing every track itself. Tiles are TILE_SIZE x TILE_SIZE pixels in the pico's GS2_HMSB framebuffer format and
+# are only written where there is something to draw. Their names are '{zoom}_{ty}_{tx}', where tile (tx, ty) covers
+# global pixels [tx * TILE_SIZE, (tx+1) * TILE_SIZE) with x = longitude in meters * scale and
+# y = -latitude in meters * scale, scale being DISPLAY_WIDTH / zoom pixels per meter.
+# index.json lists the tiles and the tracks drawn into them with their record count and width. Tracks recorded
+# later, points added to a track since and tracks whose width changed are drawn live on the pico.
+# usage: python utils/build_tiles.py [pico address to upload the tiles to]
+
+DATA_DIR = 'storage/downloads'
+TILES_DIR = os.path.join(DATA_DIR, 'tiles')
+ZOOM_LEVELS = [200, 400, 800] # numeric levels of map_properties['zoom']['levels'], in meters
+TILE_SIZE = 88
+DISPLAY_WIDTH = 176
+# must match GPS on the pico
+DIST_BETWEEN_LATITUDES = 111190
+# pixel values
+BLACK = 0
+WHITE = 3
+
+# list of (filename, width, [(lat, long), ...], record count) for all tracks in tracks.json. The record count is
+# counted like the pico's track index does, blank lines of CSV tracks don't count
+def read_tracks():
+    with open(os.path.join(DATA_DIR, 'tracks.json')) as f:
+        tracks_json = json.load(f)
+    tracks = []
+    for file, properties in tracks_json.items():
+        path = os.path.join(DATA_DIR, file)
+        if not os.path.exists(path):
+            print('Skipping missing track', file)
+            continue
+        if track_format.is_binary(file):
+            points = [(lat, long) for _, lat, long, _, _ in track_format.read_points(path)]
+        else:
+            with open(path) as f:
+                cols = f.readline().strip().split(',')
+                lat_col = cols.index('latitude')
+                long_col = cols.index('longitude')
+                points = []
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    parts = line.split(',')
+                    points.append((float(parts[lat_col]), float(parts[long_col])))
+        count = len(points)
+        points = [(lat, long) for lat, long in points if lat != 0 and long != 0]
+        tracks.append((file, properties['width'], points, count))
+    return tracks
+
+# Longitudes are converted to meters at the middle latitude of the tracks rounded to whole degrees, the same as
+# GPS.setReferenceLatitude() on the pico. The pico only uses the tiles if it comes to the same value
+def dist_between_longitudes(tracks):
+    lats = [lat for _, _, points, _ in tracks for lat, _ in points]
+    reference = round((min(lats) + max(lats)) / 2) if lats else 40
+    return round(DIST_BETWEEN_LATITUDES * math.cos(reference * math.pi / 180))
+
+# global pixel coordinates of the points at a zoom level
+def project(points, zoom, dist_long):
+    scale = DISPLAY_WIDTH / zoom
+    return np.array([(long * dist_long * scale, -lat * DIST_BETWEEN_LATITUDES * scale)
+                     for lat, long in points], dtype=np.float64).reshape(-1, 2)
+
+# pack a 2D array of pixel values (0-3) into GS2_HMSB bytes: 4 pixels per byte, leftmost pixel in the lowest bits
+def pack_gs2_hmsb(img):
+    px = img.astype(np.uint8).reshape(-1, 4)
+    return (px[:, 0] | (px[:, 1] << 2) | (px[:, 2] << 4) | (px[:, 3] << 6)).astype(np.uint8).tobytes()
+
+def render_zoom(tracks, zoom, dist_long):
+    projected = [(width - 1, project(points, zoom, dist_long)) for _, width, points, _ in tracks if len(points)]
+    # find the tiles each track touches, including its line thickness
+    tile_tracks = {}
+    for i, (radius, xy) in enumerate(projected):
+        tiles = set()
+        for dx in (-radius, radius):
+            for dy in (-radius, radius):
+                tx = np.floor((xy[:, 0] + dx) / TILE_SIZE).astype(int)
+                ty = np.floor((xy[:, 1] + dy) / TILE_SIZE).astype(int)
+                tiles.update(zip(ty.tolist(), tx.tolist()))
+        for tile in tiles:
+            tile_tracks.setdefault(tile, []).append(i)
+    # draw each tile, with the same thickness as the pico's polylines (radius of width - 1 pixels)
+    rendered = {}
+    for (ty, tx), indices in tile_tracks.items():
+        img = np.full((TILE_SIZE, TILE_SIZE), WHITE, dtype=np.uint8)
+        origin = np.array([tx * TILE_SIZE, ty * TILE_SIZE])
+        for i in indices:
+            radius, xy = projected[i]
+            pts = np.round(xy - origin).astype(np.int32).reshape(-1, 1, 2)
+            cv2.polylines(img, [pts], False, BLACK, thickness=2 * radius + 1)
+        if (img != WHITE).any():
+            rendered[f'{ty}_{tx}'] = pack_gs2_hmsb(img)
+    return rendered
+
+def build():
+    tracks = read_tracks()
+    dist_long = dist_between_longitudes(tracks)
+    os.makedirs(TILES_DIR, exist_ok=True)
+    for file in os.listdir(TILES_DIR):
+        os.remove(os.path.join(TILES_DIR, file))
+    index = {
+        'version': int(time()),
+        'tile_size': TILE_SIZE,
+        'display_width': DISPLAY_WIDTH,
+        'dist_between_latitudes': DIST_BETWEEN_LATITUDES,
+        'dist_between_longitudes': dist_long,
+        # the pico draws the points recorded since and tracks whose width changed live
+        'tracks': {file: {'count': count, 'width': width} for file, width, _, count in tracks},
+        'zooms': {},
+    }
+    for zoom in ZOOM_LEVELS:
+        rendered = render_zoom(tracks, zoom, dist_long)
+        for name, data in rendered.items():
+            with open(os.path.join(TILES_DIR, f'{zoom}_{name}'), 'wb') as f:
+                f.write(data)
+        index['zooms'][str(zoom)] = sorted(rendered.keys())
+        print(f'Zoom {zoom}m: {len(rendered)} tiles')
+    with open(os.path.join(TILES_DIR, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    return index
+
+# Send the tiles to the pico's /tile_upload route one file at a time. The index goes last so the pico never refers
+# to tiles it doesn't have yet, the pico then deletes tiles that aren't in the new index.
+def upload(address, index):
+    names = [f'{zoom}_{name}' for zoom, names in index['zooms'].items() for name in names] + ['index.json']
+    for i, name in enumerate(names):
+        with open(os.path.join(TILES_DIR, name), 'rb') as f:
+            data = f.read()
+        request = Request(f'http://{address}/tile_upload', data=data, method='POST',
+                          headers={'Tile-Name': name, 'Content-Type': 'application/octet-stream'})
+        with urlopen(request) as response:
+            response.read()
+        print(f'Uploaded {name} ({i+1}/{len(names)})')
+
+def main():
+    index = build()
+    if len(sys.argv) > 1:
+        upload(sys.argv[1], index)
+main()
@@ -0,0 +1,27 @@
+import os
+import sys
+# track_format is shared with the pico
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pico'))
+import track_format
+
+# Converts track files between the CSV and binary (.trk) formats.
+# CSV tracks are converted to binary and binary tracks to CSV, output is written next to the input file
+# usage: python utils/convert_tracks.py pico/tracks/TMC_1680813609.csv ...
+
+def convert(file):
+    name, ext = os.path.splitext(file)
+    if ext == track_format.EXTENSION:
+        output = name + '.csv'
+        track_format.binary_to_csv(file, output)
+    else:
+        output = name + track_format.EXTENSION
+        track_format.csv_to_binary(file, output)
+    print(f'{file} ({os.path.getsize(file)} bytes) -> {output} ({os.path.getsize(output)} bytes)')
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: python convert_tracks.py <track files...>')
+        return
+    for file in sys.argv[1:]:
+        convert(file)
+main()
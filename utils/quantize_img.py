@@ -1,6 +1,14 @@
+import os
+import sys
 import cv2
 import numpy as np
 from time import time
+# image_format is shared with the pico
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pico'))
+import image_format
+
+# write the packbits compressed variant of the image format if it is smaller than the raw image
+COMPRESS = True
 
 # Load image
 img: np.ndarray = cv2.imread('storage/dcim/Tasker/TMC/new.jpg')
@@ -68,23 +76,29 @@ img = img.reshape((-1, 4))
 img = np.flip(img, axis=1)
 img = img.reshape(pico_shape)
 
-# write img to file as raw bytes
+# pack img into raw bytes
+# 264*176 = 46464 pixels
+# 92928 bits = 11616 bytes if using 2 bits per pixel
+# max python int size is 4 bytes = 32 bits
+# but we want to avoid int overflow bugs which will corrupt data
+# so we can work in 16 bit chunks, which is 8 pixels at a time
+data = bytearray()
+chunk_size = 8
+img = img.reshape((-1, chunk_size))
+for i in range(img.shape[0]):
+    binary_sum = 0
+    for j in range(chunk_size):
+        if j > 0:
+            binary_sum <<= 2
+        binary_sum += img[i][j]
+    binary_sum = int(binary_sum)
+    data.extend(binary_sum.to_bytes(length=2, signed=False))
+
+# write img to file, compressed if that helps
+if COMPRESS:
+    packed = image_format.pack(data)
+    print(f'Compressed {len(data)} to {len(packed)} bytes')
+    if len(packed) < len(data):
+        data = packed
 with open('storage/dcim/Tasker/TMC/img_bytes', 'wb') as f:
-    # 264*176 = 46464 pixels
-    # 92928 bits = 11616 bytes if using 2 bits per pixel
-    # max python int size is 4 bytes = 32 bits
-    # but we want to avoid int overflow bugs which will corrupt data
-    # so we can work in 16 bit chunks, which is 8 pixels at a time
-    chunk_size = 8
-    img = img.reshape((-1, chunk_size))
-    for i in range(img.shape[0]):
-        binary_sum = 0
-        for j in range(chunk_size):
-            if j > 0:
-                binary_sum <<= 2
-            binary_sum += img[i][j]
-        binary_sum = int(binary_sum)
-        # print(binary_sum)
-        # print(bin(binary_sum)[2:].rjust(16, "0"))
-        sum_bytes = binary_sum.to_bytes(length=2, signed=False)
-        f.write(sum_bytes)
\ No newline at end of file
+    f.write(data)
@@ -1,6 +1,10 @@
 import os
+import sys
 from geopy.distance import distance as geo_distance
 import pandas as pd
+# track_format is shared with the pico
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pico'))
+import track_format
 
 input_folder = 'pico/tracks'
 output_folder = 'pico/tracks_revised'
@@ -22,7 +26,10 @@ track_df: pd.DataFrame = None
 compression_vals = []
 def revise(file):
     global track_df
-    track_df = pd.read_csv(file)
+    if track_format.is_binary(file):
+        track_df = pd.DataFrame(track_format.read_points(file), columns=track_format.CSV_HEADER.strip().split(','))
+    else:
+        track_df = pd.read_csv(file)
     original_len = len(track_df)
     print('Original Length:', original_len)
     i = 0
@@ -71,9 +78,17 @@ def revise(file):
     compression_vals.append(f'{compression}%')
     print(f'Compressed by {compression}%')
 
-# save
+# save, in the same format as the input file
 def save(file):
-    track_df.to_csv(file, index=False)
+    if track_format.is_binary(file):
+        record = bytearray(track_format.RECORD_SIZE)
+        with open(file, 'wb') as f:
+            f.write(track_format.header())
+            for row in track_df.itertuples(index=False):
+                track_format.pack_record(record, 0, *row)
+                f.write(record)
+    else:
+        track_df.to_csv(file, index=False)
 
 def main():
     for i, filename in enumerate(filenames):